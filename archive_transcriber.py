@@ -0,0 +1,230 @@
+# Archive / VOD transcription: decode a finished stream's audio and transcribe it much faster than real time
+#
+#   python archive_transcriber.py <video id, YouTube URL or audio file> [--output transcript.txt] [--processes 4]
+
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import tempfile
+import time
+from typing import List, Optional
+import numpy as np
+from vad import ABSOLUTE_FLOOR_DB
+from whisper_transcriber import (
+    INFERENCE_MAX_BATCH, SAMPLE_RATE, WHISPER_BACKEND, InferenceScheduler, Segment, create_backend,
+    drop_repeated_prefix, load_scheduler, segments_to_words,
+)
+
+# Chunks stay below Whisper's 30 s window, including the overlap with the previous chunk
+ARCHIVE_CHUNK_SECONDS = float(os.getenv("ARCHIVE_CHUNK_SECONDS", "28"))
+ARCHIVE_OVERLAP_SECONDS = float(os.getenv("ARCHIVE_OVERLAP_SECONDS", "1.0"))
+# Cut at the quietest frame within this many seconds before the chunk limit
+ARCHIVE_CUT_SEARCH_SECONDS = float(os.getenv("ARCHIVE_CUT_SEARCH_SECONDS", "6"))
+# Extensions read as raw 16 kHz mono float32 without ffmpeg
+RAW_PCM_EXTENSIONS = (".f32", ".pcm", ".raw")
+
+FRAME_SECONDS = 0.03
+
+def frame_energy_db(audio, frame_len=int(SAMPLE_RATE * FRAME_SECONDS), block_frames=20000):
+    """Energy per 30 ms frame, computed block by block so memory-mapped hours of audio are never loaded at once"""
+    n_frames = len(audio) // frame_len
+    energy = np.empty(n_frames, dtype=np.float32)
+    for first in range(0, n_frames, block_frames):
+        last = min(first + block_frames, n_frames)
+        frames = np.asarray(audio[first * frame_len:last * frame_len], dtype=np.float32).reshape(-1, frame_len)
+        energy[first:last] = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+    return energy
+
+def plan_chunks(audio, chunk_seconds=ARCHIVE_CHUNK_SECONDS, overlap_seconds=ARCHIVE_OVERLAP_SECONDS,
+                search_seconds=ARCHIVE_CUT_SEARCH_SECONDS):
+    """Split audio at silence into (start, join, end) sample ranges.
+
+    Each chunk owns [join, end) and also decodes `overlap_seconds` before
+    its join point, so a word cut by the boundary is heard whole by one of
+    the two chunks. Chunks that are silent throughout are left out.
+    """
+    frame_len = int(SAMPLE_RATE * FRAME_SECONDS)
+    energy = frame_energy_db(audio, frame_len)
+    n_frames = len(energy)
+    max_frames = int(chunk_seconds / FRAME_SECONDS)
+    search_frames = min(int(search_seconds / FRAME_SECONDS), max_frames // 2)
+    overlap = int(overlap_seconds * SAMPLE_RATE)
+    chunks = []
+    join = 0
+    while join < n_frames:
+        limit = join + max_frames
+        if limit >= n_frames:
+            cut = n_frames
+        else:
+            # Latest quietest frame, so chunks come out as long as possible
+            cut = limit - 1 - int(np.argmin(energy[limit - search_frames:limit][::-1]))
+        if energy[join:cut].max() > ABSOLUTE_FLOOR_DB:
+            start = max(join * frame_len - overlap, 0)
+            end = len(audio) if cut == n_frames else cut * frame_len
+            chunks.append((start, join * frame_len, end))
+        join = cut
+    return chunks
+
+def stitch(chunks, results, overlap_seconds=ARCHIVE_OVERLAP_SECONDS) -> List[Segment]:
+    """Merge per-chunk segments into one timeline; text from the overlap is kept once"""
+    stitched = []
+    tail = []
+    for (start, join, end), segments in zip(chunks, results):
+        offset = start / SAMPLE_RATE
+        # Words starting this close after the join may repeat what the previous chunk already said
+        overlap_until = join / SAMPLE_RATE + overlap_seconds
+        for segment in segments:
+            middle = offset + (segment.start + segment.end) / 2
+            # The overlap before the join point belongs to the previous chunk
+            if middle < join / SAMPLE_RATE and stitched:
+                continue
+            words = segments_to_words([segment], offset)
+            n = sum(1 for word in words if word.start < overlap_until)
+            words = drop_repeated_prefix(tail, words[:n]) + words[n:]
+            if not words:
+                continue
+            stitched.append(Segment(words[0].start, offset + segment.end, " ".join(w.text for w in words)))
+            tail = (tail + words)[-5:]
+    return stitched
+
+def check_range(start=0.0, end=None):
+    """Raise ValueError for a [start, end) range ffmpeg should never see"""
+    if start < 0:
+        raise ValueError(f"start must not be negative (got {start})")
+    if end is not None and end <= start:
+        raise ValueError(f"end must be after start (got {start}..{end})")
+
+async def decode_audio(source, path, start=0.0, end=None, local_files=False):
+    """Decode (and download, for videos) source to raw 16 kHz mono float32 at path with ffmpeg.
+
+    source is a YouTube video ID or URL; a path on this machine only with
+    local_files, which must never be set for input from Discord users.
+    """
+    check_range(start, end)
+    if local_files and os.path.exists(source):
+        url = source
+    else:
+        from audio_streamer import parse_video_id, stream_url_resolver
+        video_id = parse_video_id(source)
+        if video_id is None:
+            raise ValueError(f"Not a YouTube video ID or URL: {source}")
+        url = await stream_url_resolver.resolve(video_id)
+        if not url:
+            raise RuntimeError(f"Could not get an audio URL for {video_id}")
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y']
+    if start:
+        cmd += ['-ss', str(start)]
+    if end:
+        cmd += ['-t', str(end - start)]
+    cmd += ['-i', url, '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', '1', '-ar', str(SAMPLE_RATE), path]
+    proc = await asyncio.create_subprocess_exec(*cmd, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(f"ffmpeg failed ({proc.returncode}): {stderr.decode(errors='replace').strip()[-300:]}")
+
+def open_raw(path, start=0.0, end=None):
+    audio = np.memmap(path, dtype=np.float32, mode="r")
+    return audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE) if end else None]
+
+async def transcribe_audio(audio, scheduler: InferenceScheduler, concurrency=None, offset=0.0, progress=None):
+    """Transcribe a (memory-mapped) array chunk by chunk; returns segments with absolute times"""
+    loop = asyncio.get_running_loop()
+    # Reading energy for hours of audio takes a moment; keep the event loop responsive
+    chunks = await loop.run_in_executor(None, plan_chunks, audio)
+    # Enough chunks in flight to fill every batch, few enough that live streams sharing the scheduler still get turns
+    slots = asyncio.Semaphore(concurrency or scheduler.max_batch * 2)
+    done = 0
+
+    async def run(chunk):
+        nonlocal done
+        start, _, end = chunk
+        async with slots:
+            # Copy out of the memory map only while the chunk is in flight
+            segments = await scheduler.submit(np.array(audio[start:end], dtype=np.float32))
+        done += 1
+        if progress:
+            progress(done, len(chunks))
+        return segments
+
+    results = await asyncio.gather(*(run(chunk) for chunk in chunks))
+    return [
+        Segment(offset + segment.start, offset + segment.end, segment.text)
+        for segment in stitch(chunks, results)
+    ]
+
+async def transcribe_archive(source, scheduler: Optional[InferenceScheduler] = None, start=0.0, end=None,
+                             concurrency=None, progress=None, local_files=False) -> List[Segment]:
+    """Transcribe a finished video (ID or URL), or with local_files an audio file, optionally only [start, end) seconds"""
+    check_range(start, end)
+    scheduler = scheduler or await load_scheduler()
+    if local_files and source.endswith(RAW_PCM_EXTENSIONS) and os.path.exists(source):
+        return await transcribe_audio(open_raw(source, start, end), scheduler, concurrency, start, progress)
+    with tempfile.NamedTemporaryFile(suffix=".f32") as tmp:
+        await decode_audio(source, tmp.name, start, end, local_files)
+        return await transcribe_audio(open_raw(tmp.name), scheduler, concurrency, start, progress)
+
+def format_timestamp(seconds, srt=False):
+    seconds = max(seconds, 0.0)
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, secs = divmod(rest, 60)
+    if srt:
+        return f"{hours:02d}:{minutes:02d}:{secs:02d},{int(seconds * 1000) % 1000:03d}"
+    return f"{hours}:{minutes:02d}:{secs:02d}"
+
+def format_transcript(segments, srt=False):
+    """Plain "[H:MM:SS] text" lines, or SubRip subtitles"""
+    if srt:
+        return "\n".join(
+            f"{i}\n{format_timestamp(s.start, True)} --> {format_timestamp(s.end, True)}\n{s.text}\n"
+            for i, s in enumerate(segments, 1)
+        )
+    return "\n".join(f"[{format_timestamp(s.start)}] {s.text}" for s in segments)
+
+def build_scheduler(processes, backend_name=WHISPER_BACKEND, max_batch=INFERENCE_MAX_BATCH):
+    """A scheduler using every core: one model per process, cores split evenly between them"""
+    threads = max((os.cpu_count() or 1) // processes, 1)
+    if processes <= 1:
+        return InferenceScheduler(create_backend(backend_name, cpu_threads=threads), max_batch=max_batch)
+    from worker_pool import ProcessPoolBackend
+    backend = ProcessPoolBackend(
+        processes, max_batch, backend_factory=functools.partial(create_backend, backend_name, cpu_threads=threads)
+    )
+    return InferenceScheduler(backend, max_batch=max_batch, workers=processes)
+
+async def run_cli(args):
+    scheduler = build_scheduler(args.processes, args.backend, args.batch)
+    started = time.monotonic()
+
+    def progress(done, total):
+        if done == total or done % max(total // 20, 1) == 0:
+            print(f"{done}/{total} chunks ({time.monotonic() - started:.0f}s)", file=sys.stderr)
+
+    try:
+        segments = await transcribe_archive(
+            args.source, scheduler, args.start, args.end, progress=progress, local_files=True
+        )
+    finally:
+        scheduler.close()
+    text = format_transcript(segments, srt=(args.output or "").endswith(".srt"))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"Wrote {len(segments)} segments to {args.output} in {time.monotonic() - started:.0f}s", file=sys.stderr)
+    else:
+        print(text)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Transcribe a finished stream, VOD or audio file")
+    parser.add_argument("source", help="YouTube video ID/URL, an audio/video file, or raw 16 kHz f32le (.f32/.pcm)")
+    parser.add_argument("--output", help="Write the transcript here (.srt for subtitles); default stdout")
+    parser.add_argument("--start", type=float, default=0.0, help="Start offset in seconds")
+    parser.add_argument("--end", type=float, help="End offset in seconds")
+    parser.add_argument("--processes", type=int, default=1, help="Model processes; cores are split between them")
+    parser.add_argument("--batch", type=int, default=max(INFERENCE_MAX_BATCH, 8), help="Chunks per model batch")
+    parser.add_argument("--backend", default=WHISPER_BACKEND, help="faster-whisper or stub")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    asyncio.run(run_cli(parse_args()))
@@ -1,61 +1,352 @@
 import asyncio
-import subprocess
-from yt_dlp import YoutubeDL
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import metrics
+
+# Refresh a cached stream URL this many seconds before it expires
+STREAM_URL_EXPIRY_MARGIN = int(os.getenv("STREAM_URL_EXPIRY_MARGIN", "120"))
+# TTL for URLs that carry no expire timestamp
+STREAM_URL_DEFAULT_TTL = int(os.getenv("STREAM_URL_DEFAULT_TTL", "300"))
+
+# Start decoding after minimal probing and without input buffering
+INGEST_LOW_LATENCY = os.getenv("INGEST_LOW_LATENCY", "1") == "1"
+# Restart ffmpeg when no audio has arrived for this long
+INGEST_STALL_TIMEOUT = float(os.getenv("INGEST_STALL_TIMEOUT", "10"))
+# Reconnect backoff: 0.5 s doubling up to this cap
+INGEST_RECONNECT_MAX_DELAY = float(os.getenv("INGEST_RECONNECT_MAX_DELAY", "8"))
+# Give up after this many connection attempts in a row that produced no audio
+INGEST_MAX_RECONNECTS = int(os.getenv("INGEST_MAX_RECONNECTS", "6"))
+# Gaps between audio progress reports longer than this count as stalls (live HLS arrives in segments)
+INGEST_STALL_REPORT = float(os.getenv("INGEST_STALL_REPORT", "6"))
+
+LOW_LATENCY_INPUT_ARGS = ['-fflags', 'nobuffer', '-flags', 'low_delay', '-probesize', '32768', '-analyzeduration', '200000']
+# ffmpeg's own HTTP reconnect covers short network blips without a restart
+RECONNECT_INPUT_ARGS = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '2']
+
+YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+}
+
+# A bare YouTube video ID
+VIDEO_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+# Path prefixes of youtube.com URLs that carry the video ID as the next path component
+VIDEO_PATH_PREFIXES = ('live', 'shorts', 'embed', 'v')
+
+def parse_video_id(source) -> Optional[str]:
+    """The video ID of a bare ID or a youtube.com / youtu.be URL; None for anything else"""
+    source = source.strip()
+    if VIDEO_ID_RE.fullmatch(source):
+        return source
+    parsed = urlparse(source if '://' in source else f'https://{source}')
+    host = (parsed.hostname or '').lower()
+    parts = parsed.path.strip('/').split('/')
+    if parsed.scheme not in ('http', 'https'):
+        return None
+    if host == 'youtu.be':
+        candidate = parts[0]
+    elif host == 'youtube.com' or host.endswith('.youtube.com'):
+        if parsed.path == '/watch':
+            candidate = parse_qs(parsed.query).get('v', [''])[0]
+        else:
+            candidate = parts[1] if len(parts) > 1 and parts[0] in VIDEO_PATH_PREFIXES else ''
+    else:
+        return None
+    return candidate if VIDEO_ID_RE.fullmatch(candidate) else None
+
+def parse_url_expiry(url) -> Optional[float]:
+    """Return the expire timestamp embedded in a googlevideo URL, if any"""
+    parsed = urlparse(url)
+    expire = parse_qs(parsed.query).get('expire')
+    if expire:
+        return float(expire[0])
+    # HLS manifests for live streams put it in the path: .../expire/1700000000/...
+    match = re.search(r'/expire/(\d+)', parsed.path)
+    if match:
+        return float(match.group(1))
+    return None
+
+class StreamUrlResolver:
+    """Caches yt-dlp stream URLs per video until shortly before they expire.
+
+    Concurrent lookups for the same video share one extraction, and each
+    executor thread keeps its own YoutubeDL instance so extractors are
+    only initialised once.
+    """
+
+    def __init__(self, max_workers=2):
+        # {video_id: (url, expires_at)}
+        self._cache: Dict[str, Tuple[str, float]] = {}
+        # {video_id: in-flight extraction}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yt-dlp")
+        self._local = threading.local()
+
+    def _get_ydl(self):
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            # yt-dlp takes a noticeable share of startup to import; pay it on first use (or in prewarm)
+            from yt_dlp import YoutubeDL
+            ydl = YoutubeDL(YDL_OPTS)
+            self._local.ydl = ydl
+        return ydl
+
+    def _extract(self, video_id):
+        video_url = video_id if video_id.startswith('http') else f'https://www.youtube.com/watch?v={video_id}'
+        info = self._get_ydl().extract_info(video_url, download=False)
+        # Find the best audio URL
+        if 'url' in info:
+            return info['url']
+        # Sometimes 'formats' is present
+        if 'formats' in info:
+            for f in info['formats']:
+                if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
+                    return f['url']
+        return None
+
+    def get_cached(self, video_id):
+        entry = self._cache.get(video_id)
+        if entry and time.time() < entry[1] - STREAM_URL_EXPIRY_MARGIN:
+            return entry[0]
+        return None
+
+    def invalidate(self, video_id):
+        self._cache.pop(video_id, None)
+
+    def _store(self, video_id, url):
+        now = time.time()
+        expires_at = parse_url_expiry(url) or now + STREAM_URL_DEFAULT_TTL
+        self._cache[video_id] = (url, expires_at)
+        # Drop entries for streams that have long since expired
+        for key in [k for k, (_, exp) in self._cache.items() if exp <= now]:
+            del self._cache[key]
+
+    async def _resolve_uncached(self, video_id):
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.Timer(metrics.ytdlp_resolve_seconds.labels(video_id)):
+                url = await loop.run_in_executor(self._executor, self._extract, video_id)
+        finally:
+            self._pending.pop(video_id, None)
+        if url:
+            self._store(video_id, url)
+        return url
+
+    async def resolve(self, video_id):
+        url = self.get_cached(video_id)
+        if url:
+            return url
+        pending = self._pending.get(video_id)
+        if pending is None:
+            pending = asyncio.create_task(self._resolve_uncached(video_id))
+            self._pending[video_id] = pending
+        # Shield so one cancelled caller does not abort the lookup for the others
+        return await asyncio.shield(pending)
+
+    async def prewarm(self):
+        """Import yt-dlp and set up its extractors ahead of the first lookup"""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._get_ydl)
+
+    def prefetch(self, video_id):
+        """Start resolving in the background, e.g. as soon as a channel goes live"""
+        if self.get_cached(video_id) or video_id in self._pending:
+            return None
+
+        async def _prefetch():
+            try:
+                await self.resolve(video_id)
+            except Exception as e:
+                print(f"Prefetching stream URL for {video_id} failed: {e}")
+        return asyncio.create_task(_prefetch())
+
+# Shared by every AudioStreamer so restarts and other guilds hit the same cache
+stream_url_resolver = StreamUrlResolver()
+
+async def pump_pipe(read_fd, ring, video_id):
+    """Read a PCM pipe straight into the ring whenever it is readable, until EOF. Closes read_fd."""
+    os.set_blocking(read_fd, False)
+    loop = asyncio.get_running_loop()
+    eof = loop.create_future()
+    started = time.perf_counter()
+    first_audio = False
+    ingested = metrics.audio_ingested_seconds.labels(video_id)
+    overrun = metrics.audio_overrun_seconds.labels(video_id)
+    def on_readable():
+        nonlocal first_audio
+        try:
+            written = ring.samples_written
+            dropped = ring.overrun_samples
+            if ring.fill_from_fd(read_fd) == 0 and not eof.done():
+                eof.set_result(None)
+            if ring.samples_written > written:
+                if not first_audio:
+                    first_audio = True
+                    metrics.ffmpeg_first_audio_seconds.labels(video_id).observe(time.perf_counter() - started)
+                ingested.inc((ring.samples_written - written) / ring.sample_rate)
+            if ring.overrun_samples > dropped:
+                overrun.inc((ring.overrun_samples - dropped) / ring.sample_rate)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if not eof.done():
+                eof.set_exception(e)
+    loop.add_reader(read_fd, on_readable)
+    try:
+        await eof
+    finally:
+        loop.remove_reader(read_fd)
+        os.close(read_fd)
+
+def build_ffmpeg_cmd(stream_url, sample_rate, low_latency=INGEST_LOW_LATENCY):
+    """ffmpeg decoding to mono float32 PCM on stdout, with key=value progress reports on stderr"""
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-progress', 'pipe:2']
+    if low_latency:
+        cmd += LOW_LATENCY_INPUT_ARGS
+    if stream_url.startswith('http'):
+        cmd += RECONNECT_INPUT_ARGS
+    cmd += ['-i', stream_url, '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', '1', '-ar', str(sample_rate), '-']
+    return cmd
+
+class FfmpegProgress:
+    """Follows ffmpeg's -progress output for one connection: time to first audio and stalls"""
+    __slots__ = ("video_id", "started", "first_audio", "out_time", "last_advance", "stalls", "errors")
+
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.started = time.monotonic()
+        self.first_audio = None  # seconds from start until ffmpeg produced audio
+        self.out_time = 0.0
+        self.last_advance = self.started
+        self.stalls = 0
+        # Last few error lines, for the log when ffmpeg fails
+        self.errors = deque(maxlen=5)
+
+    def feed_line(self, line):
+        key, sep, value = line.partition('=')
+        if not sep or ' ' in key:
+            self.errors.append(line)
+            return
+        if key != 'out_time_us':
+            return
+        try:
+            out_time = int(value) / 1e6
+        except ValueError:
+            # N/A until the first frame
+            return
+        if out_time <= self.out_time:
+            return
+        now = time.monotonic()
+        if self.first_audio is None:
+            self.first_audio = now - self.started
+        elif now - self.last_advance > INGEST_STALL_REPORT:
+            self.stalls += 1
+            metrics.ingest_stall_seconds.labels(self.video_id).observe(now - self.last_advance)
+        self.out_time = out_time
+        self.last_advance = now
+
+    async def read(self, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            self.feed_line(line.decode(errors='replace').strip())
+
+    def stalled_for(self):
+        return time.monotonic() - self.last_advance
 
 class AudioStreamer:
-    def __init__(self):
-        pass
+    def __init__(self, resolver=None):
+        self.resolver = resolver or stream_url_resolver
 
     async def get_audio_stream_url(self, video_id: str) -> str:
-        # Use yt_dlp Python API to get the best audio stream URL
-        video_url = video_id if video_id.startswith('http') else f'https://www.youtube.com/watch?v={video_id}'
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-        }
-        loop = asyncio.get_event_loop()
-        def extract():
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(video_url, download=False)
-                # Find the best audio URL
-                if 'url' in info:
-                    return info['url']
-                # Sometimes 'formats' is present
-                if 'formats' in info:
-                    for f in info['formats']:
-                        if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
-                            return f['url']
-                return None
-        stream_url = await loop.run_in_executor(None, extract)
-        return stream_url
-
-    async def stream_audio(self, video_id: str, chunk_size: int = 4096):
-        # 1. Get direct audio stream URL
+        return await self.resolver.resolve(video_id)
+
+    async def stream_into(self, video_id: str, ring):
+        """Fill the PCM ring buffer until the stream ends, reconnecting ffmpeg after drops and stalls.
+
+        A reconnect after audio has flowed reuses the cached stream URL and
+        starts after 0.5 s; attempts that produce nothing re-extract the URL
+        and back off exponentially. ffmpeg exiting cleanly means the stream
+        is over.
+        """
+        failures = 0
+        reconnects = metrics.ingest_reconnects.labels(video_id)
+        while True:
+            written_before = ring.samples_written
+            try:
+                returncode = await self._run_ffmpeg(video_id, ring)
+            except Exception as e:
+                # Typically yt-dlp or ffmpeg failing to start; counts as an attempt without audio
+                print(f"Ingest for {video_id} could not connect: {e}")
+                returncode = None
+            got_audio = ring.samples_written > written_before
+            if returncode == 0:
+                return
+            if got_audio:
+                failures = 0
+            else:
+                failures += 1
+                # Most likely an expired or rejected URL; extract again next time
+                self.resolver.invalidate(video_id)
+                if failures >= INGEST_MAX_RECONNECTS:
+                    raise RuntimeError(f"ffmpeg produced no audio for {video_id} in {failures} attempts")
+            delay = min(0.5 * 2 ** failures, INGEST_RECONNECT_MAX_DELAY)
+            print(f"Ingest for {video_id} dropped (ffmpeg exit {returncode}), reconnecting in {delay:.1f}s")
+            reconnects.inc()
+            await asyncio.sleep(delay)
+
+    async def _run_ffmpeg(self, video_id, ring):
+        """One ffmpeg connection; returns its exit code"""
+        # 1. Get direct audio stream URL (cached across restarts)
         stream_url = await self.get_audio_stream_url(video_id)
         if not stream_url:
             raise RuntimeError('Could not get stream URL from yt-dlp')
 
-        # 2. Start ffmpeg to transcode and pipe audio
-        ffmpeg_cmd = [
-            'ffmpeg', '-i', stream_url,
-            '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', '16000', '-'
-        ]
-        proc = await asyncio.create_subprocess_exec(
-            *ffmpeg_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.DEVNULL
-        )
-
-        # 3. Yield audio chunks
+        # 2. Start ffmpeg writing float32 PCM into a pipe we read ourselves
+        read_fd, write_fd = os.pipe()
         try:
-            while True:
-                chunk = await proc.stdout.read(chunk_size)
-                if not chunk:
-                    break
-                yield chunk
+            proc = await asyncio.create_subprocess_exec(
+                *build_ffmpeg_cmd(stream_url, ring.sample_rate),
+                stdout=write_fd,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except Exception:
+            os.close(read_fd)
+            raise
         finally:
-            if proc.stdout:
-                proc.stdout.close()
-            await proc.wait() 
\ No newline at end of file
+            os.close(write_fd)
+
+        # 3. Read straight into the ring whenever the pipe is readable
+        progress = FfmpegProgress(video_id)
+        reader = asyncio.create_task(progress.read(proc.stderr))
+        watchdog = asyncio.create_task(self._watchdog(proc, progress))
+        try:
+            await pump_pipe(read_fd, ring, video_id)
+        finally:
+            watchdog.cancel()
+            if proc.returncode is None:
+                proc.terminate()
+            await proc.wait()
+            await reader
+        if progress.first_audio is not None:
+            print(f"Ingest for {video_id}: first audio after {progress.first_audio:.2f}s, {progress.stalls} stalls")
+        if proc.returncode and progress.errors:
+            print(f"ffmpeg for {video_id} exited with {proc.returncode}: {progress.errors[-1]}")
+        return proc.returncode
+
+    async def _watchdog(self, proc, progress):
+        """Kill ffmpeg when it stops producing audio so the connection is re-established"""
+        while proc.returncode is None:
+            await asyncio.sleep(1)
+            if progress.stalled_for() > INGEST_STALL_TIMEOUT:
+                print(f"Ingest for {progress.video_id} stalled for {progress.stalled_for():.0f}s, restarting ffmpeg")
+                proc.terminate()
+                return
@@ -0,0 +1,491 @@
+# Offline end-to-end benchmark for the YouTube-Whisper-Discord pipeline
+# Runs the real main.py orchestration against a fake Holodex server, synthetic audio and a fake Discord sink
+#
+#   python benchmark.py --guilds 1,5,20 --streams 1,2,4 --duration 60 --speed 4 --output bench_results.json
+#   python benchmark.py --soak 12    # 12 h of audio at 200x; exits 1 if memory keeps growing
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import gc
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from collections import deque
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+# Fast polling so go-live is noticed quickly; must be set before main is imported
+os.environ.setdefault("POLL_INTERVAL", "1")
+# Unscheduled streams: keep idle backoff short so go-live latency stays comparable
+os.environ.setdefault("POLL_MAX_IDLE_DELAY", "2")
+# Archive transcripts in memory rather than next to the script
+os.environ.setdefault("TRANSCRIPT_DB_PATH", ":memory:")
+
+import numpy as np
+import holodex_monitor
+import main
+import memory_accounting
+import metrics
+import stream_hub
+from audio_streamer import pump_pipe
+from discord_bot import DiscordBot
+from settings_store import GuildSettingsStore
+from transcript_archive import TranscriptArchive
+from whisper_transcriber import InferenceScheduler, Segment, StubBackend, set_scheduler
+from worker_pool import ProcessPoolBackend
+
+main.setup()
+
+SAMPLE_RATE = 16000
+# Synthetic streams alternate speech-like bursts with silence
+BURST_SECONDS = 1.5
+GAP_SECONDS = 1.5
+# Each burst has its own fundamental so the fake model can tell which one it heard
+N_TONES = 40
+WRITE_CHUNK_SECONDS = 0.02
+# Holodex keeps listing a stream as live for a while after it ends; the bot must not replay it meanwhile
+HOLODEX_OFFLINE_LAG = 5.0
+
+def burst_frequency(index):
+    return 150.0 + 20.0 * (index % N_TONES)
+
+def synth_burst(index):
+    t = np.arange(int(BURST_SECONDS * SAMPLE_RATE)) / SAMPLE_RATE
+    f0 = burst_frequency(index)
+    wave = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+    envelope = np.clip(np.minimum(t, BURST_SECONDS - t) / 0.05, 0, 1)
+    return (0.1 * wave * envelope).astype(np.float32)
+
+def percentile(values, q):
+    if not values:
+        return None
+    return float(np.percentile(values, q))
+
+class FakeHolodex:
+    """Scriptable stand-in for the Holodex /users/live endpoint"""
+
+    def __init__(self):
+        # {channel_id: video_id} of channels that are live right now
+        self.live: Dict[str, str] = {}
+        self.requests = 0
+        self.server = None
+        self.port = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1")
+            while (await reader.readline()).strip():
+                pass
+            self.requests += 1
+            target = urlparse(request_line.split()[1])
+            channels = parse_qs(target.query).get("channels", [""])[0].split(",")
+            videos = [
+                {"id": self.live[c], "status": "live", "type": "stream", "channel": {"id": c}}
+                for c in channels if c in self.live
+            ]
+            body = json.dumps(videos).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+class SyntheticAudioStreamer:
+    """Stands in for yt-dlp + ffmpeg: a writer thread plays PCM into the ring's pipe at `speed`x real time"""
+
+    speed = 1.0
+    duration = 30.0
+    pcm_file = None
+    record_bursts = True
+    # {video_id: [(burst index, monotonic time its last sample was written)]}
+    bursts: Dict[str, List] = {}
+    # {video_id: monotonic time its audio ended}
+    finished: Dict[str, float] = {}
+    # Streams started again for a video that had already ended
+    replays = 0
+
+    def __init__(self, resolver=None):
+        pass
+
+    def _periods(self):
+        """Yield (audio, burst index or None) pieces; synthetic audio is generated one period at a time"""
+        if self.pcm_file:
+            yield np.fromfile(self.pcm_file, dtype=np.float32)[:int(self.duration * SAMPLE_RATE)], None
+            return
+        period = int((BURST_SECONDS + GAP_SECONDS) * SAMPLE_RATE)
+        bursts = [synth_burst(i) for i in range(N_TONES)]
+        # Silence first, like a stream opening on a waiting screen
+        gap = np.full(period - len(bursts[0]), 1e-4, dtype=np.float32)
+        for i in range(int(self.duration * SAMPLE_RATE) // period):
+            yield gap, None
+            yield bursts[i % N_TONES], i
+
+    def _write(self, fd, video_id):
+        log = self.bursts.setdefault(video_id, []) if self.record_bursts else None
+        # Fewer, larger writes at high speed-ups (soak runs)
+        chunk = int(WRITE_CHUNK_SECONDS * SAMPLE_RATE * max(1.0, self.speed / 50))
+        written = 0
+        started = time.monotonic()
+        try:
+            for audio, burst in self._periods():
+                for pos in range(0, len(audio), chunk):
+                    # Pace against the wall clock like a live stream
+                    delay = started + written / SAMPLE_RATE / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    piece = audio[pos:pos + chunk]
+                    os.write(fd, piece.tobytes())
+                    written += len(piece)
+                if burst is not None and log is not None:
+                    log.append((burst, time.monotonic()))
+        except OSError:
+            # Reader went away (pipeline cancelled)
+            pass
+        finally:
+            os.close(fd)
+
+    async def stream_into(self, video_id, ring):
+        if video_id in self.finished:
+            SyntheticAudioStreamer.replays += 1
+        read_fd, write_fd = os.pipe()
+        writer = threading.Thread(target=self._write, args=(write_fd, video_id), daemon=True)
+        writer.start()
+        await pump_pipe(read_fd, ring, video_id)
+        self.finished[video_id] = time.monotonic()
+
+class BenchBackend(StubBackend):
+    """Fake model: costs `rtf` seconds per audio second and names the burst it heard"""
+
+    def __init__(self, rtf=0.1):
+        self.rtf = rtf
+
+    def transcribe_batch(self, windows, beam_size=None):
+        time.sleep(self.rtf * sum(len(w) for w in windows) / SAMPLE_RATE)
+        results = []
+        for window in windows:
+            spectrum = np.abs(np.fft.rfft(window))
+            freqs = np.fft.rfftfreq(len(window), 1 / SAMPLE_RATE)
+            band = (freqs >= 140) & (freqs <= 150 + 20 * N_TONES)
+            f0 = freqs[band][np.argmax(spectrum[band])]
+            index = int(round((f0 - 150.0) / 20.0)) % N_TONES
+            results.append([Segment(0.0, len(window) / SAMPLE_RATE, f"burst:{index}")])
+        return results
+
+class FakeChannel:
+    def __init__(self, channel_id, guild_id, sink):
+        self.id = channel_id
+        self.guild = SimpleNamespace(id=guild_id)
+        self.sink = sink
+
+    async def send(self, content):
+        self.sink.append((self.id, time.monotonic(), content))
+        return FakeMessage(self)
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, content):
+        self.channel.sink.append((self.channel.id, time.monotonic(), content))
+
+class FakeDiscordBot(DiscordBot):
+    """The real DiscordBot delivery path, with channels that only record what was sent"""
+
+    def __init__(self):
+        super().__init__("benchmark", settings_store=GuildSettingsStore(":memory:"))
+        self.deliveries = []
+        self._channels = {}
+
+    def get_channel(self, channel_id):
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            guild_id = next(g for g, s in self.guild_settings.items() if s.get("output_channel_id") == channel_id)
+            channel = self._channels[channel_id] = FakeChannel(channel_id, guild_id, self.deliveries)
+        return channel
+
+def match_latencies(bot, bursts, video_by_channel):
+    """Pair each delivered burst:N marker with the earliest unmatched burst of that video"""
+    latencies = []
+    matched = {}
+    for channel_id, delivered_at, content in bot.deliveries:
+        video_id = video_by_channel[channel_id]
+        used = matched.setdefault(channel_id, set())
+        for index in re.findall(r"burst:(\d+)", content):
+            for i, (burst_index, ended_at) in enumerate(bursts.get(video_id, [])):
+                if i in used or burst_index % N_TONES != int(index) or ended_at > delivered_at:
+                    continue
+                used.add(i)
+                latencies.append(delivered_at - ended_at)
+                break
+    return latencies
+
+def rss_mb():
+    return memory_accounting.rss_bytes() / 2**20
+
+async def reset_orchestration():
+    for guild_id in list(main.tasks):
+        await main.stop_guild_monitor(guild_id)
+    main.tasks.clear()
+    main.monitors.clear()
+    main.manually_stopped.clear()
+    await main.poller.close()
+
+def cpu_seconds():
+    # Worker processes count once they have been joined
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    )
+
+async def run_scenario(n_guilds, n_streams, duration, speed, model_rtf, pcm_file=None, processes=0,
+                       on_tick=None, record=True):
+    """One end-to-end run; on_tick() is called every 0.2 s, record=False keeps no per-burst history (soak runs)"""
+    holodex = FakeHolodex()
+    await holodex.start()
+    holodex_monitor.HOLODEX_API_URL = holodex.url
+    if processes:
+        backend = ProcessPoolBackend(processes, backend_factory=functools.partial(BenchBackend, model_rtf))
+        scheduler = InferenceScheduler(backend, workers=processes)
+    else:
+        scheduler = InferenceScheduler(BenchBackend(model_rtf))
+    set_scheduler(scheduler)
+    SyntheticAudioStreamer.speed = speed
+    SyntheticAudioStreamer.duration = duration
+    SyntheticAudioStreamer.pcm_file = pcm_file
+    SyntheticAudioStreamer.record_bursts = record
+    SyntheticAudioStreamer.bursts = {}
+    SyntheticAudioStreamer.finished = {}
+    SyntheticAudioStreamer.replays = 0
+    stream_hub.AudioStreamer = SyntheticAudioStreamer
+
+    bot = FakeDiscordBot()
+    if not record:
+        bot.deliveries = deque(maxlen=100)
+    channels = [f"UCbench{i:04d}" for i in range(n_streams)]
+    video_by_channel = {}
+    for g in range(n_guilds):
+        guild_id = 1000 + g
+        output_channel_id = 5000 + g
+        bot.guild_settings[guild_id] = {"holodex_channel_id": channels[g % n_streams], "output_channel_id": output_channel_id}
+        video_by_channel[output_channel_id] = f"benchvid{g % n_streams:04d}"
+
+    cpu_before = cpu_seconds()
+    started = time.monotonic()
+    main.poller.start()
+    await asyncio.gather(*(main.start_guild_monitor(guild_id, bot) for guild_id in bot.guild_settings))
+    # Scripted go-live for every channel
+    for i, channel in enumerate(channels):
+        holodex.live[channel] = f"benchvid{i:04d}"
+
+    deadline = started + duration / speed + HOLODEX_OFFLINE_LAG + 30
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+        if on_tick:
+            on_tick()
+        for channel, video_id in list(holodex.live.items()):
+            ended_at = SyntheticAudioStreamer.finished.get(video_id)
+            if ended_at is not None and time.monotonic() - ended_at > HOLODEX_OFFLINE_LAG:
+                del holodex.live[channel]
+        if not holodex.live and not stream_hub_busy():
+            break
+    holodex.live.clear()
+    # Let the output queues drain before tearing down
+    await asyncio.sleep(2)
+    wall = time.monotonic() - started
+    await reset_orchestration()
+    scheduler.close()
+    cpu = cpu_seconds() - cpu_before
+    for channel_id in list(bot.output.outboxes):
+        await bot.output.remove(channel_id)
+    await holodex.stop()
+
+    latencies = match_latencies(bot, SyntheticAudioStreamer.bursts, video_by_channel)
+    expected = sum(
+        len(SyntheticAudioStreamer.bursts.get(video_by_channel[5000 + g], [])) for g in range(n_guilds)
+    )
+    return {
+        "guilds": n_guilds,
+        "streams": n_streams,
+        "audio_seconds": duration,
+        "speed": speed,
+        "model_rtf": model_rtf,
+        "processes": processes,
+        "wall_seconds": round(wall, 3),
+        "bursts_expected": expected,
+        "bursts_delivered": len(latencies),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "cpu_seconds_per_stream": round(cpu / n_streams, 3),
+        "cpu_percent_per_stream": round(100 * cpu / wall / n_streams, 1),
+        "rss_mb": round(rss_mb(), 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "holodex_requests": holodex.requests,
+        "replays": SyntheticAudioStreamer.replays,
+    }
+
+def stream_hub_busy():
+    return any(not p.task.done() for p in main.hub.pipelines.values())
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return None
+
+async def run_benchmark(args):
+    scenarios = []
+    for n_streams in args.streams:
+        for n_guilds in args.guilds:
+            if n_guilds < n_streams:
+                continue
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                result = await run_scenario(n_guilds, n_streams, args.duration, args.speed or 1.0, args.model_rtf, args.pcm, args.processes)
+            print(
+                f"guilds={n_guilds:4d} streams={n_streams:3d} "
+                f"p50={result['latency_p50'] or float('nan'):.2f}s p99={result['latency_p99'] or float('nan'):.2f}s "
+                f"delivered={result['bursts_delivered']}/{result['bursts_expected']} replays={result['replays']} "
+                f"cpu/stream={result['cpu_percent_per_stream']}% rss={result['rss_mb']}MB"
+            )
+            scenarios.append(result)
+    return {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "scenarios": scenarios,
+    }
+
+class SoakSampler:
+    """Samples RSS, live object count and traced memory per stage every `every` seconds of stream audio"""
+
+    def __init__(self, every):
+        self.every = every
+        self.samples = []
+        self._next = every
+
+    def tick(self):
+        ingested = sum(child.value for child in metrics.audio_ingested_seconds._children.values())
+        if ingested < self._next:
+            return
+        self._next += self.every
+        gc.collect()
+        stages = memory_accounting.stage_usage()
+        self.samples.append({
+            "audio_hours": round(ingested / 3600, 2),
+            "rss_mb": round(rss_mb(), 1),
+            "objects": len(gc.get_objects()),
+            "traced_mb": {stage: round(size / 2**20, 2) for stage, size in sorted(stages.items())},
+        })
+        sample = self.samples[-1]
+        print(f"  {sample['audio_hours']:6.2f}h rss={sample['rss_mb']}MB objects={sample['objects']} "
+              + " ".join(f"{stage}={mb}MB" for stage, mb in sample["traced_mb"].items()), file=sys.stderr)
+
+def soak_slope(samples, key):
+    """Least-squares growth per stream hour, after skipping the first quarter of the samples as warm-up"""
+    steady = samples[len(samples) // 4:]
+    hours = [s["audio_hours"] for s in steady]
+    return float(np.polyfit(hours, [key(s) for s in steady], 1)[0])
+
+async def run_soak(args):
+    """One long synthetic stream at high speed; fails if memory or object counts keep growing"""
+    memory_accounting.start(args.trace_frames)
+    speed = args.speed or 200.0
+    sampler = SoakSampler(args.soak_sample_minutes * 60)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Archived transcripts are data, not a leak: keep them on disk
+        main.transcripts = main.hub.archive = TranscriptArchive(os.path.join(tmp, "transcripts.db"))
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            # The model keeps the same share of real time as on a live stream
+            result = await run_scenario(1, 1, args.soak * 3600, speed, args.model_rtf / speed,
+                                        processes=args.processes, on_tick=sampler.tick, record=False)
+        await main.transcripts.close()
+    samples = sampler.samples
+    if len(samples) < 4:
+        raise SystemExit("Soak run too short to judge; use more hours or a smaller --soak-sample-minutes")
+    rss_growth = soak_slope(samples, lambda s: s["rss_mb"])
+    object_growth = soak_slope(samples, lambda s: s["objects"])
+    stage_growth = {
+        stage: round(soak_slope(samples, lambda s: s["traced_mb"].get(stage, 0.0)), 3)
+        for stage in samples[-1]["traced_mb"]
+    }
+    passed = (rss_growth <= args.max_rss_growth and object_growth <= args.max_object_growth
+              and all(mb <= args.max_stage_growth for mb in stage_growth.values()))
+    print(
+        f"soak {args.soak}h at {speed:.0f}x, growth per stream hour: rss {rss_growth:+.2f}MB (max {args.max_rss_growth}), "
+        f"objects {object_growth:+.0f} (max {args.max_object_growth:.0f}) -> {'PASS' if passed else 'FAIL'}"
+    )
+    if stage_growth:
+        print(f"traced per stage (max {args.max_stage_growth}MB): "
+              + ", ".join(f"{stage} {mb:+.3f}MB" for stage, mb in stage_growth.items()))
+    return {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "soak": {
+            **result,
+            "passed": passed,
+            "rss_growth_mb_per_hour": round(rss_growth, 3),
+            "object_growth_per_hour": round(object_growth, 1),
+            "stage_growth_mb_per_hour": stage_growth,
+            "samples": samples,
+        },
+    }
+
+def parse_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end pipeline benchmark")
+    parser.add_argument("--guilds", type=parse_list, default=[1, 5, 20], help="Comma-separated guild counts")
+    parser.add_argument("--streams", type=parse_list, default=[1, 2, 4], help="Comma-separated concurrent stream counts")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of audio per stream")
+    parser.add_argument("--speed", type=float, help="Playback speed relative to real time (default 1, or 200 for --soak)")
+    parser.add_argument("--model-rtf", type=float, default=0.1, help="Simulated model cost per audio second")
+    parser.add_argument("--processes", type=int, default=0, help="Run the model in this many worker processes")
+    parser.add_argument("--pcm", help="Raw 16 kHz mono f32le file to play instead of synthetic bursts (no latency figures)")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own log output")
+    parser.add_argument("--soak", type=float, help="Instead: stream this many hours of audio and check memory stays flat")
+    parser.add_argument("--soak-sample-minutes", type=float, default=30, help="Stream minutes between soak samples")
+    parser.add_argument("--max-rss-growth", type=float, default=2.0, help="Soak fails above this RSS growth (MB per stream hour)")
+    parser.add_argument("--max-object-growth", type=float, default=500, help="Soak fails above this many new live objects per stream hour")
+    parser.add_argument("--max-stage-growth", type=float, default=0.25, help="Soak fails if a stage's traced memory grows faster (MB per stream hour)")
+    parser.add_argument("--trace-frames", type=int, default=4, help="tracemalloc frames for per-stage soak accounting (0 = off)")
+    return parser.parse_args(argv)
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run_soak(args) if args.soak else run_benchmark(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.soak and not results["soak"]["passed"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
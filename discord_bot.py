@@ -1,15 +1,23 @@
 import asyncio
+import io
 import discord
 from discord.ext import commands
 from discord import app_commands
+from audio_streamer import parse_video_id
+from discord_output import TranscriptOutput
+from settings_store import GuildSettingsStore
 
 class DiscordBot(commands.Bot):
-    def __init__(self, token):
+    def __init__(self, token, settings_store=None):
         intents = discord.Intents.default()
         super().__init__(command_prefix="!", intents=intents)
         self.token = token
+        # Persistent settings; guild_settings is its in-memory cache
+        self.settings_store = settings_store or GuildSettingsStore()
         # {guild_id: {"holodex_channel_id": str, "output_channel_id": int}}
-        self.guild_settings = {}
+        self.guild_settings = self.settings_store.cache
+        self.gateway_ready = asyncio.Event()  # Set once the gateway has delivered the guild list
+        self.output = TranscriptOutput(self)  # Per-channel coalescing, rate-limited transcript delivery
         self.on_channel_update = None  # Callback for channel updates
         self.on_guild_join_callback = None  # Callback for when bot joins a guild
         self.on_guild_remove_callback = None  # Callback for when bot leaves a guild
@@ -17,12 +25,20 @@ class DiscordBot(commands.Bot):
         self.on_manual_start_callback = None  # Callback for manual start
         self.on_manual_stop_callback = None  # Callback for manual stop
         self.get_monitor_status_callback = None  # Callback to get current monitor status
+        self.get_metrics_summary_callback = None  # Callback to get a pipeline metrics summary
+        self.on_archive_request_callback = None  # Callback to transcribe a finished stream or VOD
+        self.search_transcripts_callback = None  # Callback to search archived transcripts
+        self.get_transcript_history_callback = None  # Callback to read a time range of an archived transcript
 
     async def setup_hook(self):
         # Commands are auto-registered when using @bot.tree.command()
         await self.tree.sync()
         print("Slash commands synced globally")
 
+    async def on_ready(self):
+        print(f"Bot ready as {self.user} in {len(self.guilds)} guilds")
+        self.gateway_ready.set()
+
     async def on_guild_join(self, guild):
         """Called when the bot joins a new guild"""
         print(f"Bot joined guild: {guild.name} (ID: {guild.id})")
@@ -32,9 +48,12 @@ class DiscordBot(commands.Bot):
     async def on_guild_remove(self, guild):
         """Called when the bot leaves a guild"""
         print(f"Bot left guild: {guild.name} (ID: {guild.id})")
-        # Clean up guild settings
+        # Clean up guild settings and the transcript queue of its output channel
         if guild.id in self.guild_settings:
-            del self.guild_settings[guild.id]
+            output_channel_id = self.guild_settings[guild.id].get("output_channel_id")
+            if output_channel_id:
+                await self.output.remove(output_channel_id)
+            self.settings_store.delete(guild.id)
         if self.on_guild_remove_callback:
             await self.on_guild_remove_callback(guild.id)
 
@@ -55,8 +74,35 @@ class DiscordBot(commands.Bot):
         if channel:
             await channel.send(message)
 
+    async def send_transcript(self, guild_id, transcript, final=True):
+        """Queue a transcript segment; non-final segments may be edited in place later"""
+        channel_id = self.guild_settings.get(guild_id, {}).get("output_channel_id")
+        if not channel_id:
+            return
+        self.output.put(channel_id, transcript, final)
+
+    async def send_bulk(self, guild_id, text):
+        """Post a long text as full messages to the output channel"""
+        channel_id = self.guild_settings.get(guild_id, {}).get("output_channel_id")
+        if channel_id:
+            await self.output.send_bulk(channel_id, text)
+
+    async def send_file(self, guild_id, filename, text, message=None):
+        channel_id = self.guild_settings.get(guild_id, {}).get("output_channel_id")
+        channel = self.get_channel(channel_id) if channel_id else None
+        if channel:
+            await channel.send(message, file=discord.File(io.BytesIO(text.encode("utf-8")), filename=filename))
+
+    def get_output_stats(self, guild_id):
+        channel_id = self.guild_settings.get(guild_id, {}).get("output_channel_id")
+        return self.output.get_stats(channel_id) if channel_id else None
+
     def get_guild_settings(self, guild_id):
-        return self.guild_settings.get(guild_id, {})
+        return self.settings_store.get(guild_id)
+
+    def update_guild_setting(self, guild_id, key, value):
+        """Update one setting; it is written to disk in the background"""
+        self.settings_store.set(guild_id, key, value)
 
     def run_bot(self):
         super().run(self.token)
@@ -67,9 +113,7 @@ def setup_commands(bot):
     @app_commands.describe(channel_id="Holodex channel ID (YouTube channel ID)")
     async def set_monitor_channel(interaction: discord.Interaction, channel_id: str):
         guild_id = interaction.guild_id
-        if guild_id not in bot.guild_settings:
-            bot.guild_settings[guild_id] = {}
-        bot.guild_settings[guild_id]["holodex_channel_id"] = channel_id
+        bot.update_guild_setting(guild_id, "holodex_channel_id", channel_id)
         
         # Notify main.py of the channel update
         if bot.on_channel_update:
@@ -85,9 +129,7 @@ def setup_commands(bot):
     @app_commands.describe(channel="The channel to send transcripts to")
     async def set_output_channel(interaction: discord.Interaction, channel: discord.TextChannel):
         guild_id = interaction.guild_id
-        if guild_id not in bot.guild_settings:
-            bot.guild_settings[guild_id] = {}
-        bot.guild_settings[guild_id]["output_channel_id"] = channel.id
+        bot.update_guild_setting(guild_id, "output_channel_id", channel.id)
         
         # Check if monitoring should start/stop
         if bot.on_settings_update_callback:
@@ -139,6 +181,75 @@ def setup_commands(bot):
         else:
             await interaction.response.send_message("❌ Service not available.", ephemeral=True)
 
+    @bot.tree.command(name="archive", description="Transcribe a finished stream or VOD faster than real time.")
+    @app_commands.describe(
+        video="YouTube video ID or URL",
+        as_file="Upload the transcript as one text file instead of posting messages",
+        start="Start offset in seconds (e.g. where live transcription stopped)",
+        end="End offset in seconds (0 = until the end)",
+    )
+    async def archive(interaction: discord.Interaction, video: str, as_file: bool = False,
+                      start: float = 0.0, end: float = 0.0):
+        guild_id = interaction.guild_id
+
+        if not bot.get_guild_settings(guild_id).get("output_channel_id"):
+            await interaction.response.send_message(
+                "❌ Set an output channel with `/set_output_channel` first.", ephemeral=True
+            )
+            return
+
+        # Only YouTube videos: a path or arbitrary URL would let members read files or reach hosts via the bot
+        video_id = parse_video_id(video)
+        if video_id is None:
+            await interaction.response.send_message(
+                "❌ Give a YouTube video ID or a youtube.com / youtu.be link.", ephemeral=True
+            )
+            return
+        if start < 0 or (end and end <= start):
+            await interaction.response.send_message(
+                "❌ `start` must be 0 or more and `end` (if set) after `start`.", ephemeral=True
+            )
+            return
+
+        if bot.on_archive_request_callback:
+            started = await bot.on_archive_request_callback(guild_id, bot, video_id, as_file, start, end or None)
+            if started:
+                await interaction.response.send_message(
+                    f"📼 Transcribing `{video_id}` in the background; the transcript will be posted to the output channel.",
+                    ephemeral=True
+                )
+            else:
+                await interaction.response.send_message(
+                    "⚠️ An archive transcription is already running for this server.", ephemeral=True
+                )
+        else:
+            await interaction.response.send_message("❌ Service not available.", ephemeral=True)
+
+    @bot.tree.command(name="search", description="Search transcripts of this server's channel for keywords.")
+    @app_commands.describe(
+        query="Words that must all appear (end a word with * to match a prefix)",
+        video="Only search this video ID",
+    )
+    async def search(interaction: discord.Interaction, query: str, video: str = None):
+        if bot.search_transcripts_callback:
+            result = await bot.search_transcripts_callback(interaction.guild_id, bot, query, video)
+            await interaction.response.send_message(result, ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ Service not available.", ephemeral=True)
+
+    @bot.tree.command(name="history", description="Show what was said in a stream around a given time.")
+    @app_commands.describe(
+        video="YouTube video ID (default: this server's latest stream)",
+        at="Start time in the video, H:MM:SS or seconds (default: the last few minutes)",
+        minutes="How many minutes to show",
+    )
+    async def history(interaction: discord.Interaction, video: str = None, at: str = None, minutes: float = 5.0):
+        if bot.get_transcript_history_callback:
+            result = await bot.get_transcript_history_callback(interaction.guild_id, bot, video, at, minutes)
+            await interaction.response.send_message(result, ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ Service not available.", ephemeral=True)
+
     @bot.tree.command(name="status", description="Check the current configuration and monitoring status.")
     async def status(interaction: discord.Interaction):
         guild_id = interaction.guild_id
@@ -169,6 +280,21 @@ def setup_commands(bot):
             status_text += "🟢 **Monitoring:** Active\n"
         else:
             status_text += "🔴 **Monitoring:** Inactive\n"
+
+        # Transcript delivery backlog
+        output_stats = bot.get_output_stats(guild_id)
+        if output_stats:
+            status_text += (
+                f"📨 **Delivery:** {output_stats['queue_depth']} queued, "
+                f"lag {output_stats['last_lag']:.1f}s (max {output_stats['max_lag']:.1f}s), "
+                f"{output_stats['rate_limited']} rate-limited\n"
+            )
+
+        # Pipeline metrics
+        if bot.get_metrics_summary_callback:
+            summary = bot.get_metrics_summary_callback(guild_id)
+            if summary:
+                status_text += f"📈 **Metrics:**\n{summary}\n"
         
         # Instructions
         if not config_complete:
@@ -0,0 +1,345 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+import discord
+import metrics
+
+DISCORD_MESSAGE_LIMIT = 2000
+# How long a transcript segment may wait to be merged with the ones after it
+OUTPUT_LATENCY_BUDGET = float(os.getenv("OUTPUT_LATENCY_BUDGET", "1.5"))
+# Edit the latest message while the hypothesis is still changing instead of posting new ones
+OUTPUT_EDIT_IN_PLACE = os.getenv("OUTPUT_EDIT_IN_PLACE", "0") == "1"
+# Discord allows about 5 messages per 5 seconds per channel
+OUTPUT_RATE = int(os.getenv("OUTPUT_RATE", "5"))
+OUTPUT_RATE_PERIOD = float(os.getenv("OUTPUT_RATE_PERIOD", "5"))
+# Segments a channel may have waiting (e.g. during a long rate limit); the oldest are dropped beyond this
+OUTPUT_MAX_QUEUE = int(os.getenv("OUTPUT_MAX_QUEUE", "500"))
+# Pause before retrying a batch Discord failed to take (5xx); 429s wait for the rate-limit reset instead
+OUTPUT_RETRY_DELAY = float(os.getenv("OUTPUT_RETRY_DELAY", "1.0"))
+
+def is_transient(error):
+    """Whether a failed Discord request is worth retrying: rate limits and server errors"""
+    return isinstance(error, discord.HTTPException) and (error.status == 429 or error.status >= 500)
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Split text into chunks of at most `limit` characters, preferring line breaks, then spaces"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+class TokenBucket:
+    """Per-channel send budget that also obeys Discord's rate-limit headers"""
+    __slots__ = ("capacity", "refill_rate", "tokens", "_updated", "_blocked_until", "rate_limited")
+
+    def __init__(self, rate=OUTPUT_RATE, period=OUTPUT_RATE_PERIOD):
+        self.capacity = rate
+        self.refill_rate = rate / period
+        self.tokens = float(rate)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self.rate_limited = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.refill_rate)
+
+    def update_from_headers(self, headers):
+        """Apply X-RateLimit-* / Retry-After headers from a Discord response"""
+        retry_after = headers.get("Retry-After") or headers.get("X-RateLimit-Reset-After")
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is not None:
+            self._refill()
+            self.tokens = min(self.tokens, float(remaining))
+        if retry_after is not None and (remaining is None or float(remaining) == 0):
+            self._blocked_until = max(self._blocked_until, time.monotonic() + float(retry_after))
+
+class ChannelOutbox:
+    """Delivery queue for one Discord channel.
+
+    Segments are merged into messages of up to 2000 characters. A batch is
+    flushed once its oldest segment has waited latency_budget seconds or
+    it can fill a whole message.
+    """
+
+    def __init__(self, channel, latency_budget=OUTPUT_LATENCY_BUDGET, edit_in_place=OUTPUT_EDIT_IN_PLACE,
+                 max_queue=OUTPUT_MAX_QUEUE):
+        self.channel = channel
+        self.max_queue = max_queue
+        self.latency_budget = latency_budget
+        self.edit_in_place = edit_in_place
+        self.bucket = TokenBucket()
+        guild = getattr(channel, "guild", None)
+        self.guild_label = str(guild.id) if guild is not None else ""
+        # (text, enqueued_at) of committed segments
+        self._queue = deque()
+        self._queued_chars = 0
+        # Latest unstable hypothesis; replaced, never queued
+        self._partial: Optional[str] = None
+        self._partial_at = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Message currently being extended by edits
+        self._live_message = None
+        self._live_text = ""
+        # Whether the live message currently ends with a partial after _live_text
+        self._live_partial = False
+        self.messages_sent = 0
+        self.messages_edited = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def put(self, text, final=True):
+        if final:
+            if len(self._queue) >= self.max_queue:
+                # Stale text is worth less than memory; the channel is far behind anyway
+                old, _ = self._queue.popleft()
+                self._queued_chars -= len(old) + 1
+                self.dropped += 1
+            self._queue.append((text, time.monotonic()))
+            self._queued_chars += len(text) + 1
+        elif self.edit_in_place:
+            if self._partial is None:
+                self._partial_at = time.monotonic()
+            self._partial = text
+        else:
+            # Without edit-in-place only committed text is posted
+            return
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def oldest_age(self):
+        ages = []
+        if self._queue:
+            ages.append(time.monotonic() - self._queue[0][1])
+        if self._partial is not None:
+            ages.append(time.monotonic() - self._partial_at)
+        return max(ages, default=0.0)
+
+    async def _wait_for_batch(self):
+        while not self._queue and self._partial is None:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        while self._queued_chars < DISCORD_MESSAGE_LIMIT:
+            remaining = self.latency_budget - self.oldest_age()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+    def _take_batch(self):
+        texts = []
+        size = 0
+        oldest = None
+        while self._queue and size + len(self._queue[0][0]) + 1 <= DISCORD_MESSAGE_LIMIT:
+            text, enqueued_at = self._queue.popleft()
+            oldest = enqueued_at if oldest is None else oldest
+            texts.append(text)
+            size += len(text) + 1
+            self._queued_chars -= len(text) + 1
+        if not texts and self._queue:
+            # A single segment longer than one message; it is split when sent
+            text, oldest = self._queue.popleft()
+            self._queued_chars -= len(text) + 1
+            texts.append(text)
+        partial, self._partial = self._partial, None
+        if oldest is None and partial is not None:
+            oldest = self._partial_at
+        return " ".join(texts), partial, oldest
+
+    def _requeue(self, committed, partial, oldest):
+        if committed:
+            self._queue.appendleft((committed, oldest if oldest is not None else time.monotonic()))
+            self._queued_chars += len(committed) + 1
+        if partial is not None and self._partial is None:
+            # A newer partial replaces this one anyway
+            self._partial = partial
+            self._partial_at = oldest if oldest is not None else time.monotonic()
+
+    async def _send(self, content):
+        await self.bucket.acquire()
+        try:
+            with metrics.Timer(metrics.discord_send_seconds.labels(self.guild_label)):
+                message = await self.channel.send(content)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                self.bucket.rate_limited += 1
+                metrics.discord_rate_limited.labels(self.guild_label).inc()
+            if e.response is not None:
+                self.bucket.update_from_headers(e.response.headers)
+            raise
+        self.messages_sent += 1
+        return message
+
+    async def _edit(self, content):
+        await self.bucket.acquire()
+        try:
+            with metrics.Timer(metrics.discord_send_seconds.labels(self.guild_label)):
+                await self._live_message.edit(content=content)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                self.bucket.rate_limited += 1
+                metrics.discord_rate_limited.labels(self.guild_label).inc()
+            if e.response is not None:
+                self.bucket.update_from_headers(e.response.headers)
+            raise
+        self.messages_edited += 1
+
+    async def _deliver(self, committed, partial):
+        if not self.edit_in_place:
+            for chunk in split_message(committed):
+                await self._send(chunk)
+            return
+        # Committed text is appended to the live message; the partial is shown after it until replaced
+        live_text = " ".join(t for t in (self._live_text, committed) if t)
+        content = " ".join(t for t in (live_text, partial) if t)
+        if self._live_message is not None and len(content) <= DISCORD_MESSAGE_LIMIT:
+            try:
+                await self._edit(content)
+                self._live_text = live_text
+                self._live_partial = bool(partial)
+                return
+            except (discord.NotFound, discord.Forbidden) as e:
+                # The live message was deleted or can no longer be edited: start a new one
+                print(f"Live message in channel {self.channel.id} is gone ({e.status}); posting a new one")
+                self._live_message = None
+                self._live_text = ""
+                self._live_partial = False
+        if self._live_message is not None and self._live_partial:
+            await self._drop_live_partial()
+        chunks = split_message(" ".join(t for t in (committed, partial) if t))
+        for chunk in chunks:
+            self._live_message = await self._send(chunk)
+        # Only the committed part of the last message stays when the partial is replaced
+        last = chunks[-1] if chunks else ""
+        self._live_partial = bool(partial) and last.endswith(partial)
+        self._live_text = last[:len(last) - len(partial)].rstrip() if self._live_partial else last
+
+    async def _drop_live_partial(self):
+        """Edit the live message back to its committed text before moving on to a new one"""
+        try:
+            if self._live_text:
+                await self._edit(self._live_text)
+            else:
+                # It only ever showed a partial, which the new message repeats or replaces
+                await self.bucket.acquire()
+                await self._live_message.delete()
+        except (discord.NotFound, discord.Forbidden) as e:
+            print(f"Could not clear the partial from the live message in channel {self.channel.id} ({e.status})")
+        self._live_partial = False
+
+    async def _run(self):
+        while True:
+            await self._wait_for_batch()
+            committed, partial, oldest = self._take_batch()
+            if not committed and not partial:
+                continue
+            try:
+                await self._deliver(committed, partial)
+            except Exception as e:
+                if not is_transient(e):
+                    print(f"Failed to deliver transcript to channel {self.channel.id}: {e}")
+                    continue
+                # Put the batch back in front of anything newer and try again
+                print(f"Retrying transcript delivery to channel {self.channel.id}: {e}")
+                self._requeue(committed, partial, oldest)
+                if e.status != 429:
+                    await asyncio.sleep(OUTPUT_RETRY_DELAY)
+                continue
+            if oldest is not None:
+                self.last_lag = time.monotonic() - oldest
+                self.max_lag = max(self.max_lag, self.last_lag)
+                metrics.delivery_lag_seconds.labels(self.guild_label).observe(self.last_lag)
+
+    async def send_bulk(self, text):
+        """Post a long text (e.g. an archive transcript) as full messages, within the rate limit"""
+        for chunk in split_message(text):
+            await self._send(chunk)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "oldest_age": self.oldest_age(),
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "messages_sent": self.messages_sent,
+            "messages_edited": self.messages_edited,
+            "rate_limited": self.bucket.rate_limited,
+            "dropped": self.dropped,
+        }
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+class TranscriptOutput:
+    """Owns one ChannelOutbox per output channel"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.outboxes: Dict[int, ChannelOutbox] = {}
+
+    def get_outbox(self, channel_id) -> Optional[ChannelOutbox]:
+        outbox = self.outboxes.get(channel_id)
+        if outbox is None:
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                return None
+            outbox = ChannelOutbox(channel)
+            self.outboxes[channel_id] = outbox
+        return outbox
+
+    def put(self, channel_id, text, final=True):
+        outbox = self.get_outbox(channel_id)
+        if outbox:
+            outbox.put(text, final)
+
+    async def send_bulk(self, channel_id, text):
+        outbox = self.get_outbox(channel_id)
+        if outbox:
+            await outbox.send_bulk(text)
+
+    def get_stats(self, channel_id):
+        outbox = self.outboxes.get(channel_id)
+        return outbox.stats() if outbox else None
+
+    async def remove(self, channel_id):
+        outbox = self.outboxes.pop(channel_id, None)
+        if outbox:
+            await outbox.close()
+            metrics.registry.forget("guild", outbox.guild_label)
@@ -1,29 +1,283 @@
 import asyncio
+import heapq
 import os
+import random
+import time
+from datetime import datetime
 import httpx
+import metrics
+from typing import Dict, List, Optional, Set, Tuple
+
+HOLODEX_API_URL = os.getenv("HOLODEX_API_URL", "https://holodex.net/api/v2")
+# Number of channel IDs sent in a single /users/live request
+HOLODEX_BATCH_SIZE = int(os.getenv("HOLODEX_BATCH_SIZE", "50"))
+# Longest an idle channel goes unpolled; bounds how late a surprise stream is noticed
+POLL_MAX_IDLE_DELAY = float(os.getenv("POLL_MAX_IDLE_DELAY", "120"))
+# Poll at full speed from this long before a scheduled start until this long after it
+POLL_SCHEDULE_WINDOW_BEFORE = float(os.getenv("POLL_SCHEDULE_WINDOW_BEFORE", "300"))
+POLL_SCHEDULE_WINDOW_AFTER = float(os.getenv("POLL_SCHEDULE_WINDOW_AFTER", "1800"))
+# Random +/- fraction added to every poll delay
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1"))
 
 class HolodexMonitor:
-    def __init__(self, channel_id):
+    def __init__(self, channel_id, poller=None):
         self.channel_id = channel_id
-        self.api_key = os.getenv("HOLODEX_API_KEY", "YOUR_HOLODEX_API_KEY")
+        self.poller = poller
+        self.live_video_id = None
+        # Video whose stream we saw end while Holodex still lists it as live
+        self.ended_video_id = None
+        self._changed = asyncio.Event()
 
     def set_channel_id(self, channel_id):
-        self.channel_id = channel_id
+        # The old channel's state says nothing about the new one
+        self.live_video_id = None
+        self.ended_video_id = None
+        if self.poller and self.poller.is_subscribed(self):
+            # Move the subscription; the poller reports the new channel's known state or polls it right away
+            self.poller.unsubscribe(self)
+            self.channel_id = channel_id
+            self.poller.subscribe(self)
+        else:
+            self.channel_id = channel_id
+        self._changed.set()
+
+    def notify(self, video_id):
+        """Called by the poller when the live state of our channel changes"""
+        self.live_video_id = video_id
+        if video_id != self.ended_video_id:
+            # Offline or another video: an ended stream counts again if it is ever reported live anew
+            self.ended_video_id = None
+        self._changed.set()
+
+    def mark_ended(self, video_id):
+        """The stream of video_id is over; do not report it again until Holodex has caught up"""
+        self.ended_video_id = video_id
+
+    async def wait_for_live(self):
+        """Wait until the poller reports a live video for our channel that has not ended yet"""
+        while not self.live_video_id or self.live_video_id == self.ended_video_id:
+            self._changed.clear()
+            await self._changed.wait()
+        return self.live_video_id
+
+    async def wait_for_channel_change(self, channel_id):
+        """Wait until the monitor is moved away from channel_id"""
+        while self.channel_id == channel_id:
+            self._changed.clear()
+            await self._changed.wait()
+
+def parse_timestamp(value) -> Optional[float]:
+    """Parse a Holodex ISO timestamp such as 2024-05-01T12:00:00.000Z"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+class HolodexPoller:
+    """Polls Holodex for every subscribed channel with one pooled client.
+
+    Channels are de-duplicated across guilds and kept in a heap ordered by
+    when they are next due. Every due channel (plus any due within the
+    coalescing window) goes out in one batched /users/live request, so the
+    request count depends on the number of distinct channels, not guilds.
+
+    The delay until a channel's next poll depends on its state:
+    - live, or near a scheduled start (from Holodex upcoming data): `interval`
+    - scheduled far ahead: wake up shortly before the start, at most max_idle_delay away
+    - idle: back off exponentially up to max_idle_delay, which bounds how
+      late a surprise stream is noticed
+    Every delay gets random jitter so channels do not synchronize.
+    """
+
+    def __init__(self, interval, batch_size=HOLODEX_BATCH_SIZE, max_idle_delay=POLL_MAX_IDLE_DELAY,
+                 window_before=POLL_SCHEDULE_WINDOW_BEFORE, window_after=POLL_SCHEDULE_WINDOW_AFTER,
+                 jitter=POLL_JITTER):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_idle_delay = max(max_idle_delay, interval)
+        self.window_before = window_before
+        self.window_after = window_after
+        self.jitter = jitter
+        self.api_key = os.getenv("HOLODEX_API_KEY", "YOUR_HOLODEX_API_KEY")
+        # {channel_id: {HolodexMonitor, ...}}
+        self._subscribers: Dict[str, Set[HolodexMonitor]] = {}
+        # {channel_id: live video id or None}
+        self._live: Dict[str, Optional[str]] = {}
+        # {video_id: actual start (Unix time)} for streams that are live now
+        self.started_at: Dict[str, float] = {}
+        # Heap of (due time, channel_id); entries not matching _due are stale
+        self._heap: List[Tuple[float, str]] = []
+        self._due: Dict[str, float] = {}
+        # {channel_id: current idle backoff delay}
+        self._backoff: Dict[str, float] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.on_live_callback = None  # Callback(channel_id, video_id) when a channel goes live
+        self.requests_sent = 0
 
-    async def get_live_video_id(self):
-        # Query Holodex API for live videos for this channel
-        url = f"https://holodex.net/api/v2/live"
-        headers = {"X-APIKEY": self.api_key}
-        params = {"channel_id": self.channel_id, "status": "live", "type": "stream", "limit": 1}
-        async with httpx.AsyncClient() as client:
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=HOLODEX_API_URL,
+                headers={"X-APIKEY": self.api_key},
+                timeout=10,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+            )
+        return self._client
+
+    def _schedule(self, channel_id, due):
+        self._due[channel_id] = due
+        heapq.heappush(self._heap, (due, channel_id))
+
+    def is_subscribed(self, monitor):
+        return monitor in self._subscribers.get(monitor.channel_id, ())
+
+    def subscribe(self, monitor):
+        """Register a guild's monitor; it is notified on live/offline changes"""
+        subscribers = self._subscribers.setdefault(monitor.channel_id, set())
+        subscribers.add(monitor)
+        # Late subscribers get the last known state right away
+        if self._live.get(monitor.channel_id):
+            monitor.notify(self._live[monitor.channel_id])
+        elif monitor.channel_id not in self._due:
+            # New channel: poll it now instead of waiting for the next round
+            self._schedule(monitor.channel_id, time.monotonic())
+            self._wakeup.set()
+
+    def unsubscribe(self, monitor):
+        subscribers = self._subscribers.get(monitor.channel_id)
+        if not subscribers:
+            return
+        subscribers.discard(monitor)
+        if not subscribers:
+            del self._subscribers[monitor.channel_id]
+            self.started_at.pop(self._live.pop(monitor.channel_id, None), None)
+            # The heap entry becomes stale and is skipped when popped
+            self._due.pop(monitor.channel_id, None)
+            self._backoff.pop(monitor.channel_id, None)
+
+    async def fetch_status(self, channel_ids: List[str]):
+        """Return ({channel_id: live video_id}, {channel_id: earliest scheduled start}, {channels whose request failed})"""
+        client = self._get_client()
+        live = {}
+        upcoming = {}
+        failed: Set[str] = set()
+        for i in range(0, len(channel_ids), self.batch_size):
+            batch = channel_ids[i:i + self.batch_size]
             try:
-                resp = await client.get(url, headers=headers, params=params, timeout=10)
+                self.requests_sent += 1
+                with metrics.Timer(metrics.holodex_poll_seconds.labels()):
+                    resp = await client.get("/users/live", params={"channels": ",".join(batch)})
                 resp.raise_for_status()
                 data = resp.json()
-                if isinstance(data, list) and data:
-                    return data[0]["id"]
-                elif isinstance(data, dict) and "items" in data and data["items"]:
-                    return data["items"][0]["id"]
             except Exception as e:
+                metrics.holodex_poll_errors.inc()
                 print(f"Holodex API error: {e}")
-        return None 
\ No newline at end of file
+                # Unknown is not offline: the caller keeps these channels' last known state
+                failed.update(batch)
+                continue
+            for video in data if isinstance(data, list) else []:
+                if video.get("type", "stream") != "stream":
+                    continue
+                channel_id = (video.get("channel") or {}).get("id") or video.get("channel_id")
+                if channel_id not in batch:
+                    continue
+                if video.get("status") == "live" and channel_id not in live:
+                    live[channel_id] = video["id"]
+                    start = parse_timestamp(video.get("start_actual"))
+                    if start:
+                        self.started_at[video["id"]] = start
+                elif video.get("status") == "upcoming":
+                    start = parse_timestamp(video.get("start_scheduled"))
+                    if start and (channel_id not in upcoming or start < upcoming[channel_id]):
+                        upcoming[channel_id] = start
+        return live, upcoming, failed
+
+    def _next_delay(self, channel_id, live, scheduled_start):
+        now = time.time()
+        if live:
+            self._backoff.pop(channel_id, None)
+            delay = self.interval
+        elif scheduled_start and scheduled_start - self.window_before <= now <= scheduled_start + self.window_after:
+            # Around the scheduled start: poll at full speed
+            self._backoff.pop(channel_id, None)
+            delay = self.interval
+        else:
+            backoff = self._backoff.get(channel_id, self.interval / 2) * 2
+            delay = self._backoff[channel_id] = min(backoff, self.max_idle_delay)
+            if scheduled_start and scheduled_start - self.window_before > now:
+                # Be awake when the schedule window opens, even if backed off further
+                delay = min(delay, scheduled_start - self.window_before - now)
+        return max(delay * (1 + random.uniform(-self.jitter, self.jitter)), 0.1)
+
+    def _pop_due(self):
+        """Channels due now, plus those due within the coalescing window so they share the request"""
+        horizon = time.monotonic() + self.interval / 2
+        due = []
+        while self._heap and self._heap[0][0] <= horizon:
+            when, channel_id = heapq.heappop(self._heap)
+            if self._due.get(channel_id) == when:
+                del self._due[channel_id]
+                due.append(channel_id)
+        return due
+
+    async def poll_once(self, channel_ids=None):
+        """Poll the given (default: all subscribed) channels, dispatch changes and reschedule them"""
+        channel_ids = list(self._subscribers) if channel_ids is None else channel_ids
+        if not channel_ids:
+            return
+        live, upcoming, failed = await self.fetch_status(channel_ids)
+        now = time.monotonic()
+        for channel_id in channel_ids:
+            if channel_id not in self._subscribers:
+                continue
+            if channel_id in failed:
+                # Retry at the normal rate, without backing off or changing what subscribers were told
+                self._schedule(channel_id, now + self.interval)
+                continue
+            video_id = live.get(channel_id)
+            self._schedule(channel_id, now + self._next_delay(channel_id, video_id, upcoming.get(channel_id)))
+            if channel_id in self._live and self._live[channel_id] == video_id:
+                continue
+            self.started_at.pop(self._live.get(channel_id), None)
+            self._live[channel_id] = video_id
+            print(f"Holodex channel {channel_id} is " + (f"live ({video_id})" if video_id else "offline"))
+            if video_id and self.on_live_callback:
+                self.on_live_callback(channel_id, video_id)
+            for monitor in list(self._subscribers.get(channel_id, ())):
+                monitor.notify(video_id)
+
+    async def run(self):
+        try:
+            while True:
+                self._wakeup.clear()
+                due = self._pop_due()
+                if due:
+                    await self.poll_once(due)
+                    continue
+                timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            print("Holodex poller was cancelled")
+            raise
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._client is not None:
+            await self._client.aclose()
@@ -2,13 +2,19 @@
 # This script coordinates the Holodex monitor, audio streamer, whisper transcriber, and Discord bot
 
 import asyncio
+import importlib
 import os
-from holodex_monitor import HolodexMonitor
-from audio_streamer import AudioStreamer
-from whisper_transcriber import WhisperTranscriber
-from discord_bot import DiscordBot, setup_commands
+import sys
+import time
+from holodex_monitor import HolodexMonitor, HolodexPoller
+from stream_hub import StreamHub
+from quality_controller import QualityController
+from audio_streamer import stream_url_resolver
+from transcript_archive import TranscriptArchive, format_segments, parse_offset
+import memory_accounting
+import metrics
 from dotenv import load_dotenv
-from typing import Dict
+from typing import Dict, Optional
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,11 +22,27 @@ load_dotenv()
 HOLODEX_CHANNEL_ID = os.getenv("HOLODEX_CHANNEL_ID", "YOUR_HOLODEX_CHANNEL_ID")
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN", "YOUR_DISCORD_BOT_TOKEN")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "10"))
+# Load the Whisper model as soon as the bot is logged in, instead of when the first stream goes live
+PREWARM_MODEL = os.getenv("PREWARM_MODEL", "1") == "1"
+
+# NumPy-heavy stages left out of the login path; imported in the background once the gateway is ready
+PREWARM_MODULES = ["pcm_buffer", "vad", "whisper_transcriber", "worker_pool", "archive_transcriber"]
 
 # Global dicts to manage monitors and tasks per guild
 monitors: Dict[int, HolodexMonitor] = {}
 tasks: Dict[int, asyncio.Task] = {}
-manually_stopped: Dict[int, bool] = {}  # Track which guilds have been manually stopped
+manually_stopped: Dict[int, bool] = {}  # Guilds that have been manually stopped (only True entries are kept)
+archive_tasks: Dict[int, asyncio.Task] = {}  # At most one archive transcription per guild
+
+# Created by setup(), not on import: inference worker processes re-import this module as __mp_main__
+# One poller shared by all guilds; it batches every subscribed channel into one request per interval
+poller: Optional[HolodexPoller] = None
+# Every committed transcript is archived on disk for /search and /history
+transcripts: Optional[TranscriptArchive] = None
+# Guilds watching the same live video share one ingest + transcription pipeline
+hub: Optional[StreamHub] = None
+# Steps streams down (and back up) a quality ladder when the model cannot keep up; created by prewarm()
+quality = None
 
 def is_guild_configured(bot, guild_id):
     """Check if guild has both holodex_channel_id and output_channel_id configured"""
@@ -31,6 +53,16 @@ def is_guild_configured(bot, guild_id):
     print(f"Guild {guild_id} config check - Holodex: {has_holodex_channel}, Output: {has_output_channel}")
     return has_holodex_channel and has_output_channel
 
+def track_task(registry, guild_id, task):
+    """Keep a guild's task in registry only while it runs, so finished tasks do not accumulate"""
+    registry[guild_id] = task
+
+    def forget(done):
+        if registry.get(guild_id) is done:
+            del registry[guild_id]
+    task.add_done_callback(forget)
+    return task
+
 def is_monitoring_active(guild_id):
     """Check if monitoring is currently active for a guild"""
     return guild_id in tasks and not tasks[guild_id].done()
@@ -41,26 +73,38 @@ async def monitor_guild(guild_id, bot):
     if guild_id not in monitors:
         settings = bot.get_guild_settings(guild_id)
         holodex_channel_id = settings.get("holodex_channel_id", HOLODEX_CHANNEL_ID)
-        monitors[guild_id] = HolodexMonitor(holodex_channel_id)
+        monitors[guild_id] = HolodexMonitor(holodex_channel_id, poller)
     holodex = monitors[guild_id]
-    audio_streamer = AudioStreamer()
-    whisper = WhisperTranscriber()
 
+    async def send(transcript, final=True):
+        await bot.send_transcript(guild_id, transcript, final)
+
+    poller.subscribe(holodex)
     try:
         while True:
-            live_video_id = await holodex.get_live_video_id()
-            if live_video_id:
-                async with await whisper.start_streaming() as whisper_stream:
-                    async for audio_chunk in audio_streamer.stream_audio(live_video_id):
-                        await whisper_stream.feed(audio_chunk)
-                        async for transcript in whisper_stream.get_transcripts():
-                            if transcript:
-                                await bot.send_transcript(guild_id, transcript)
-                # Optionally: break or continue if stream ends
+            live_video_id = await holodex.wait_for_live()
+            channel_id = holodex.channel_id
+            transcripts.register_stream(live_video_id, channel_id, poller.started_at.get(live_video_id))
+            # Returns when the stream ends; the pipeline is released if it is cancelled
+            watching = asyncio.create_task(hub.watch(live_video_id, guild_id, send))
+            moved = asyncio.create_task(holodex.wait_for_channel_change(channel_id))
+            try:
+                await asyncio.wait({watching, moved}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                moved.cancel()
+                if not watching.done():
+                    # Cancelled, or /set_monitor_channel moved us to another channel
+                    watching.cancel()
+                    await asyncio.gather(watching, return_exceptions=True)
+            if watching.done() and not watching.cancelled() and not watching.exception() and watching.result().error is None:
+                # Holodex lists an ended stream as live for a while; do not replay it meanwhile
+                holodex.mark_ended(live_video_id)
             await asyncio.sleep(POLL_INTERVAL)
     except asyncio.CancelledError:
         print(f"Monitor task for guild {guild_id} was cancelled")
         raise
+    finally:
+        poller.unsubscribe(holodex)
 
 async def start_guild_monitor(guild_id, bot, force=False):
     """Start monitoring for a specific guild if properly configured and not manually stopped"""
@@ -75,8 +119,8 @@ async def start_guild_monitor(guild_id, bot, force=False):
     
     if guild_id not in tasks or tasks[guild_id].done():
         print(f"Starting monitor for guild {guild_id}")
-        tasks[guild_id] = asyncio.create_task(monitor_guild(guild_id, bot))
-        manually_stopped[guild_id] = False  # Clear manual stop flag
+        track_task(tasks, guild_id, asyncio.create_task(monitor_guild(guild_id, bot)))
+        manually_stopped.pop(guild_id, None)  # Clear manual stop flag
         return True
     else:
         print(f"Monitor for guild {guild_id} already running")
@@ -84,11 +128,12 @@ async def start_guild_monitor(guild_id, bot, force=False):
 
 async def stop_guild_monitor(guild_id, manual=False):
     """Stop monitoring for a specific guild"""
-    if guild_id in tasks and not tasks[guild_id].done():
+    task = tasks.get(guild_id)
+    if task and not task.done():
         print(f"Stopping monitor for guild {guild_id}" + (" (manual)" if manual else ""))
-        tasks[guild_id].cancel()
+        task.cancel()
         try:
-            await tasks[guild_id]
+            await task
         except asyncio.CancelledError:
             pass
         
@@ -120,7 +165,7 @@ def on_channel_update(guild_id, new_channel_id):
     if guild_id in monitors:
         monitors[guild_id].set_channel_id(new_channel_id)
     else:
-        monitors[guild_id] = HolodexMonitor(new_channel_id)
+        monitors[guild_id] = HolodexMonitor(new_channel_id, poller)
 
 async def on_guild_join(guild_id, bot):
     """Called when bot joins a new guild - start monitoring if configured"""
@@ -129,12 +174,12 @@ async def on_guild_join(guild_id, bot):
 async def on_guild_remove(guild_id):
     """Called when bot leaves a guild - stop monitoring and cleanup"""
     await stop_guild_monitor(guild_id)
-    # Clean up manual stop tracking
-    if guild_id in manually_stopped:
-        del manually_stopped[guild_id]
-    # Clean up monitor
-    if guild_id in monitors:
-        del monitors[guild_id]
+    # Clean up manual stop tracking and the monitor
+    manually_stopped.pop(guild_id, None)
+    monitors.pop(guild_id, None)
+    archive_task = archive_tasks.get(guild_id)
+    if archive_task:
+        archive_task.cancel()
 
 async def on_settings_update(guild_id, bot):
     """Called when guild settings are updated - check if monitoring should start/stop"""
@@ -151,11 +196,143 @@ async def on_manual_stop(guild_id):
     """Handle manual stop command"""
     return await stop_guild_monitor(guild_id, manual=True)
 
+async def run_archive(guild_id, bot, source, as_file=False, start=0.0, end=None):
+    """Transcribe a finished video through the shared scheduler and post the result"""
+    from archive_transcriber import format_transcript, transcribe_archive
+    started = asyncio.get_running_loop().time()
+    try:
+        segments = await transcribe_archive(source, start=start, end=end)
+    except Exception as e:
+        # Details (ffmpeg output, URLs) stay in the log
+        print(f"Archive transcription of {source} failed: {e}")
+        await bot.send_message(guild_id, f"❌ Archive transcription of `{source}` failed; see the bot's log for details.")
+        return
+    elapsed = asyncio.get_running_loop().time() - started
+    print(f"Archive transcription of {source}: {len(segments)} segments in {elapsed:.0f}s")
+    if not segments:
+        await bot.send_message(guild_id, f"📼 No speech found in `{source}`.")
+    elif as_file:
+        await bot.send_file(guild_id, f"{source.rsplit('/', 1)[-1]}.txt", format_transcript(segments), f"📼 Transcript of `{source}`")
+    else:
+        await bot.send_message(guild_id, f"📼 Transcript of `{source}`:")
+        await bot.send_bulk(guild_id, format_transcript(segments))
+
+async def on_archive_request(guild_id, bot, source, as_file=False, start=0.0, end=None):
+    """Handle /archive; returns False if this guild already has one running"""
+    if guild_id in archive_tasks and not archive_tasks[guild_id].done():
+        return False
+    track_task(archive_tasks, guild_id, asyncio.create_task(run_archive(guild_id, bot, source, as_file, start, end)))
+    return True
+
+async def search_transcripts(guild_id, bot, query, video=None):
+    """Handle /search: newest matching segments of the guild's channel (or one video)"""
+    channel_id = None if video else bot.get_guild_settings(guild_id).get("holodex_channel_id")
+    if not video and not channel_id:
+        # Without a channel the search would cover every server's archive
+        return "❌ No channel configured; set one with `/set_monitor_channel` or pass a `video`."
+    results = await transcripts.search(query, channel_id=channel_id, video_id=video)
+    if not results:
+        return f"🔍 No transcript lines match `{query}`."
+    return f"🔍 Newest matches for `{query}`:\n" + format_segments(results)
+
+async def get_transcript_history(guild_id, bot, video=None, at=None, minutes=5.0):
+    """Handle /history: a time range of one stream (default: the end of the channel's latest one)"""
+    if not video:
+        channel_id = bot.get_guild_settings(guild_id).get("holodex_channel_id")
+        video = await transcripts.latest_video(channel_id) if channel_id else None
+        if not video:
+            return "📜 No archived streams for this server's channel yet."
+    try:
+        start = parse_offset(at) if at else None
+    except ValueError:
+        return f"❌ `{at}` is not a time; use seconds or H:MM:SS."
+    segments = await transcripts.history(video, start, minutes * 60)
+    if not segments:
+        return f"📜 No transcript for `{video}` in that range."
+    return f"📜 `{video}`:\n" + format_segments(segments)
+
 def get_monitor_status(guild_id):
     """Get current monitoring status for a guild"""
     return is_monitoring_active(guild_id)
 
+def get_metrics_summary(guild_id):
+    """Summarize pipeline metrics relevant to a guild for /status"""
+    poll = metrics.holodex_poll_seconds.labels()
+    lines = [f"Holodex poll p50 {poll.quantile(0.5):.2f}s / p99 {poll.quantile(0.99):.2f}s"]
+    monitor = monitors.get(guild_id)
+    video_id = monitor.live_video_id if monitor else None
+    pipeline = hub.pipelines.get(video_id) if video_id else None
+    if pipeline:
+        lines.append(f"Stream `{video_id}`: {pipeline.summary()}")
+        if quality is not None:
+            lines.append(f"Quality {quality.describe(video_id)}")
+    rtf = metrics.whisper_batch_rtf.labels()
+    if rtf.count:
+        lines.append(f"Model RTF p50 {rtf.quantile(0.5):.2f} / p99 {rtf.quantile(0.99):.2f}")
+    schedulers = loaded_schedulers()
+    scheduler = schedulers[0] if schedulers else None
+    if scheduler is not None and hasattr(scheduler.backend, "stats"):
+        workers = scheduler.backend.stats()
+        lines.append(f"Workers {workers['alive']}/{workers['processes']} alive, {workers['restarts']} restarts")
+    # RSS is unknown on platforms without /proc unless psutil is installed
+    rss = memory_accounting.rss_bytes()
+    stages = sorted(memory_accounting.stage_usage().items(), key=lambda item: -item[1])
+    traced = ", ".join(f"{stage} {size / 2**20:.1f} MB" for stage, size in stages[:4])
+    if rss is not None:
+        lines.append(f"Memory RSS {rss / 2**20:.0f} MB" + (f" ({traced})" if traced else ""))
+    elif traced:
+        lines.append(f"Memory traced {traced}")
+    return "\n".join(lines)
+
+def loaded_schedulers():
+    """The main and fallback schedulers that exist so far; never imports the transcriber or loads a model"""
+    whisper_transcriber = sys.modules.get("whisper_transcriber")
+    if whisper_transcriber is None:
+        return []
+    schedulers = (whisper_transcriber.get_scheduler(create=False), whisper_transcriber.get_fallback_scheduler(create=False))
+    return [scheduler for scheduler in schedulers if scheduler is not None]
+
+async def prewarm(model=PREWARM_MODEL) -> Dict[str, float]:
+    """Load the stream stages, the model and yt-dlp in the background; returns seconds per step"""
+    global quality
+    loop = asyncio.get_running_loop()
+    timings: Dict[str, float] = {}
+
+    async def step(name, load):
+        started = time.perf_counter()
+        try:
+            await load()
+        except Exception as e:
+            # Not fatal: whatever failed is loaded again (and reports its error) when a stream needs it
+            print(f"Prewarming {name} failed: {e}")
+        timings[name] = time.perf_counter() - started
+
+    for module in PREWARM_MODULES:
+        await step(module, lambda: loop.run_in_executor(None, importlib.import_module, module))
+    if quality is None:
+        quality = QualityController(hub)
+        quality.start()
+    if model:
+        # Before yt-dlp: a stream that goes live meanwhile waits on this same load instead of starting its own
+        from whisper_transcriber import load_scheduler
+        await step("model", load_scheduler)
+    await step("yt_dlp", stream_url_resolver.prewarm)
+    print("Prewarmed " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return timings
+
+def setup():
+    """Create the shared poller, transcript archive and stream hub (once)"""
+    global poller, transcripts, hub
+    if hub is None:
+        poller = HolodexPoller(POLL_INTERVAL)
+        transcripts = TranscriptArchive()
+        hub = StreamHub(archive=transcripts)
+
 async def main():
+    # Imported here so worker processes, which re-import this module, do not load discord.py
+    from discord_bot import DiscordBot, setup_commands
+
+    setup()
     discord_bot = DiscordBot(DISCORD_TOKEN)
     
     # Set up commands after creating bot instance
@@ -169,19 +346,42 @@ async def main():
     discord_bot.on_manual_start_callback = on_manual_start
     discord_bot.on_manual_stop_callback = on_manual_stop
     discord_bot.get_monitor_status_callback = get_monitor_status
+    discord_bot.get_metrics_summary_callback = get_metrics_summary
+    discord_bot.on_archive_request_callback = on_archive_request
+    discord_bot.search_transcripts_callback = search_transcripts
+    discord_bot.get_transcript_history_callback = get_transcript_history
 
-    # Start the Discord bot in the background
-    bot_task = asyncio.create_task(discord_bot.start(discord_bot.token))
+    # Optional local Prometheus-style endpoint (METRICS_PORT) and per-stage allocation tracing
+    await metrics.start_metrics_server()
+    memory_accounting.start()
 
-    # Wait for the bot to be ready and have guilds
-    await asyncio.sleep(5)  # Placeholder: replace with proper event/wait
+    # Resolve the stream URL as soon as a channel goes live, before any pipeline asks for it
+    poller.on_live_callback = lambda channel_id, video_id: stream_url_resolver.prefetch(video_id)
 
-    # Start monitors for all existing guilds (only if properly configured)
-    for guild in discord_bot.guilds:
-        await start_guild_monitor(guild.id, discord_bot)
+    # Start the shared Holodex poller and the Discord bot in the background
+    poller.start()
+    bot_task = asyncio.create_task(discord_bot.start(discord_bot.token))
+
+    try:
+        # Wait for the gateway to deliver our guilds (or for the bot to fail to start)
+        ready_task = asyncio.create_task(discord_bot.gateway_ready.wait())
+        await asyncio.wait({bot_task, ready_task}, return_when=asyncio.FIRST_COMPLETED)
+        if discord_bot.gateway_ready.is_set():
+            # Logged in: now load what streams need, without holding up the monitors
+            prewarm_task = asyncio.create_task(prewarm())
+            # Bring back every configured guild's monitor at once, from persisted settings
+            await asyncio.gather(*(start_guild_monitor(guild.id, discord_bot) for guild in discord_bot.guilds))
+        else:
+            ready_task.cancel()
 
-    # Keep the main task running
-    await bot_task
+        # Keep the main task running
+        await bot_task
+    finally:
+        await discord_bot.settings_store.close()
+        await transcripts.close()
+        for scheduler in loaded_schedulers():
+            # Stops inference worker processes, if any
+            scheduler.close()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,73 @@
+import os
+import tracemalloc
+from typing import Dict, Optional
+import metrics
+
+# Trace Python allocations with this many frames per traceback (0 = off); costs CPU and memory while on
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "0"))
+
+# Pipeline stage each of our modules allocates for
+STAGE_MODULES = {
+    "audio_streamer": "ingest",
+    "pcm_buffer": "ingest",
+    "vad": "segment",
+    "whisper_transcriber": "transcribe",
+    "worker_pool": "transcribe",
+    "archive_transcriber": "transcribe",
+    "discord_output": "deliver",
+    "discord_bot": "deliver",
+    "transcript_archive": "archive",
+    "stream_hub": "orchestration",
+    "pipeline": "orchestration",
+    "main": "orchestration",
+    "holodex_monitor": "orchestration",
+    "quality_controller": "orchestration",
+    "settings_store": "orchestration",
+    "metrics": "orchestration",
+}
+
+def start(frames=MEMORY_TRACE_FRAMES):
+    """Start tracing allocations (if frames > 0); returns whether tracing is on"""
+    if frames > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        metrics.registry.add_collector(collect_metrics)
+    return tracemalloc.is_tracing()
+
+def _stage(traceback):
+    # Innermost frame in one of our modules: library allocations count for the stage that asked for them
+    for frame in reversed(traceback):
+        module = os.path.splitext(os.path.basename(frame.filename))[0]
+        if module in STAGE_MODULES:
+            return STAGE_MODULES[module]
+    return "other"
+
+def stage_usage() -> Dict[str, int]:
+    """Bytes currently allocated per pipeline stage (empty when not tracing)"""
+    if not tracemalloc.is_tracing():
+        return {}
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ))
+    usage: Dict[str, int] = {}
+    for stat in snapshot.statistics("traceback"):
+        stage = _stage(stat.traceback)
+        usage[stage] = usage.get(stage, 0) + stat.size
+    return usage
+
+def collect_metrics():
+    for stage, size in stage_usage().items():
+        metrics.memory_traced_bytes.labels(stage).set(size)
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size, or None where neither /proc nor psutil can tell (e.g. macOS without psutil)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
@@ -0,0 +1,243 @@
+import asyncio
+import bisect
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Serve /metrics on this port; unset or 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 4.0)
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class _Metric:
+    type_name = ""
+    # Appended to the name in the exposition; HELP/TYPE must use the same name as the samples
+    suffix = ""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        self._children.pop(tuple(str(v) for v in values), None)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        name = self.name + self.suffix
+        lines = [f"# HELP {name} {self.help}", f"# TYPE {name} {self.type_name}"]
+        for key, child in list(self._children.items()):
+            lines.extend(self._render_child(_format_labels(self.label_names, key), key, child))
+        return lines
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    type_name = "counter"
+    suffix = "_total"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def _render_child(self, labels, key, child):
+        return [f"{self.name}{self.suffix}{labels} {child.value}"]
+
+class Gauge(Counter):
+    type_name = "gauge"
+    suffix = ""
+
+    def set(self, value):
+        self.labels().set(value)
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (inf if beyond the last bucket)"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, labels, key, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            bucket_labels = _format_labels(self.label_names + ("le",), key + (le,))
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+class Timer:
+    """Context manager observing elapsed seconds into a histogram child"""
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+        # Called before rendering so gauges can sample queue depths etc.
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def forget(self, label, value):
+        """Drop every series labelled label=value (a finished stream, a departed guild)"""
+        value = str(value)
+        for metric in self.metrics:
+            if label in metric.label_names:
+                i = metric.label_names.index(label)
+                for key in [key for key in metric._children if key[i] == value]:
+                    del metric._children[key]
+
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+    def render(self):
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def counter(name, help_text, labels=()):
+    return registry.register(Counter(name, help_text, labels))
+
+def gauge(name, help_text, labels=()):
+    return registry.register(Gauge(name, help_text, labels))
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return registry.register(Histogram(name, help_text, labels, buckets))
+
+# Pipeline-wide metrics, shared by every module
+holodex_poll_seconds = histogram("holodex_poll_seconds", "Latency of one batched Holodex request")
+holodex_poll_errors = counter("holodex_poll_errors", "Failed Holodex requests")
+ytdlp_resolve_seconds = histogram("ytdlp_resolve_seconds", "yt-dlp stream URL extraction time", ["video"])
+ffmpeg_first_audio_seconds = histogram("ffmpeg_first_audio_seconds", "Time from ffmpeg start to the first audio byte", ["video"])
+ingest_reconnects = counter("ingest_reconnects", "ffmpeg reconnects after a drop or stall", ["video"])
+ingest_stall_seconds = histogram("ingest_stall_seconds", "Gaps in ffmpeg audio progress longer than INGEST_STALL_REPORT", ["video"])
+audio_ingested_seconds = counter("audio_ingested_seconds", "Seconds of audio read from ffmpeg", ["video"])
+audio_overrun_seconds = counter("audio_overrun_seconds", "Seconds of audio dropped because the reader fell behind", ["video"])
+audio_transcribed_seconds = counter("audio_transcribed_seconds", "Seconds of audio sent through the model", ["video"])
+whisper_batch_seconds = histogram("whisper_batch_seconds", "Wall time of one model batch")
+whisper_batch_rtf = histogram("whisper_batch_rtf", "Model real-time factor per batch (compute / audio seconds)", buckets=RATIO_BUCKETS)
+committed_word_latency_seconds = histogram("committed_word_latency_seconds", "Time from a word's audio arriving to the word being committed", ["video"])
+quality_level = gauge("quality_level", "Quality ladder level of a stream (0 = full quality)", ["video"])
+memory_traced_bytes = gauge("memory_traced_bytes", "Python allocations per pipeline stage (MEMORY_TRACE_FRAMES > 0)", ["stage"])
+queue_depth = gauge("queue_depth", "Items waiting in a pipeline queue", ["video", "queue"])
+queue_dropped = counter("queue_dropped", "Items a full pipeline queue dropped", ["video", "queue"])
+discord_send_seconds = histogram("discord_send_seconds", "Latency of a Discord send or edit", ["guild"])
+discord_rate_limited = counter("discord_rate_limited", "Discord 429 responses", ["guild"])
+delivery_lag_seconds = histogram("delivery_lag_seconds", "Time from transcript commit to Discord delivery", ["guild"])
+
+async def _handle(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Drain the headers; we do not need them
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            body = registry.render().encode()
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        print(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST) -> Optional[asyncio.AbstractServer]:
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle, host, port)
+    print(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,120 @@
+import asyncio
+import os
+import numpy as np
+
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 4  # ffmpeg writes f32le straight into the ring
+# Largest single read from the ffmpeg pipe (one pipe buffer)
+PIPE_READ_SIZE = 65536
+
+class PcmRingBuffer:
+    """Preallocated float32 ring buffer filled directly from the ffmpeg pipe.
+
+    The writer reads into the ring with os.readv, so audio is never copied
+    into intermediate bytes objects. Readers get float32 views of the ring;
+    only a window that wraps around the end is copied, into a preallocated
+    scratch array. A window stays valid until the reader moves past it.
+    """
+
+    def __init__(self, capacity_seconds=30.0, sample_rate=SAMPLE_RATE, max_window_seconds=10.0):
+        self.sample_rate = sample_rate
+        self.capacity = int(capacity_seconds * sample_rate)
+        self._samples = np.zeros(self.capacity, dtype=np.float32)
+        self._bytes = memoryview(self._samples).cast('B')
+        self._scratch = np.zeros(int(max_window_seconds * sample_rate), dtype=np.float32)
+        # Monotonic byte positions; the ring offset is position % capacity
+        self._write_pos = 0
+        self._read_pos = 0
+        self._data_ready = asyncio.Event()
+        self.closed = False
+        # Counters for monitoring
+        self.samples_written = 0
+        self.overruns = 0
+        self.overrun_samples = 0
+
+    @property
+    def capacity_bytes(self):
+        return self.capacity * BYTES_PER_SAMPLE
+
+    def available(self):
+        """Number of complete unread samples"""
+        return self._write_pos // BYTES_PER_SAMPLE - self._read_pos // BYTES_PER_SAMPLE
+
+    def _writable_regions(self, size):
+        start = self._write_pos % self.capacity_bytes
+        first = min(size, self.capacity_bytes - start)
+        regions = [self._bytes[start:start + first]]
+        if size > first:
+            regions.append(self._bytes[:size - first])
+        return regions
+
+    def fill_from_fd(self, fd, size=PIPE_READ_SIZE):
+        """Read from a non-blocking fd straight into the ring. Returns bytes read, 0 on EOF."""
+        size = min(size, self.capacity_bytes)
+        free = self.capacity_bytes - (self._write_pos - self._read_pos)
+        if free < BYTES_PER_SAMPLE:
+            # Reader is falling behind: drop the oldest audio to make room, in whole samples, and never
+            # more than is unread (a partially written sample is kept)
+            dropped = -(-(size - free) // BYTES_PER_SAMPLE) * BYTES_PER_SAMPLE
+            unread = self._write_pos - self._read_pos
+            dropped = min(dropped, unread - unread % BYTES_PER_SAMPLE)
+            size = min(size, free + dropped)
+            self._read_pos += dropped
+            self.overruns += 1
+            self.overrun_samples += dropped // BYTES_PER_SAMPLE
+        else:
+            size = min(size, free)
+        n = os.readv(fd, self._writable_regions(size))
+        if n:
+            before = self._write_pos // BYTES_PER_SAMPLE
+            self._write_pos += n
+            self.samples_written += self._write_pos // BYTES_PER_SAMPLE - before
+            self._data_ready.set()
+        return n
+
+    def close(self):
+        """Mark the end of the stream; pending readers get what is left"""
+        self.closed = True
+        self._data_ready.set()
+
+    def peek(self, n):
+        """Return the next n unread samples as a float32 array without consuming them"""
+        n = min(n, self.available())
+        start = (self._read_pos // BYTES_PER_SAMPLE) % self.capacity
+        if start + n <= self.capacity:
+            return self._samples[start:start + n]
+        # Window wraps around the end of the ring
+        first = self.capacity - start
+        out = self._scratch[:n]
+        out[:first] = self._samples[start:]
+        out[first:] = self._samples[:n - first]
+        return out
+
+    def consume(self, n):
+        n = min(n, self.available())
+        self._read_pos += n * BYTES_PER_SAMPLE
+
+    async def wait_for(self, n):
+        """Wait until n samples are available or the stream is closed"""
+        while self.available() < n and not self.closed:
+            self._data_ready.clear()
+            await self._data_ready.wait()
+        return self.available() >= n
+
+    async def windows(self, window_samples, hop_samples=None):
+        """Yield consecutive windows; each one is consumed once the caller asks for the next"""
+        window_samples = min(window_samples, len(self._scratch))
+        hop_samples = hop_samples or window_samples
+        while True:
+            if not await self.wait_for(window_samples):
+                # End of stream: flush whatever is left
+                if self.available():
+                    yield self.peek(self.available())
+                    self.consume(self.available())
+                return
+            window = self.peek(window_samples)
+            start = self._read_pos
+            yield window
+            # An overrun while the caller held the window already moved the read position; only
+            # consume the part of the hop it did not cover, so no further audio is skipped uncounted
+            self.consume(max(0, hop_samples - (self._read_pos - start) // BYTES_PER_SAMPLE))
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import deque
+
+# Overflow policies for StageQueue
+BLOCK = "block"              # producer waits for room
+DROP_OLDEST = "drop_oldest"  # oldest item is discarded (real-time audio)
+MERGE = "merge"              # new item is folded into the newest one (text)
+
+class StageQueue:
+    """Bounded queue between two pipeline stages with an explicit overflow policy.
+
+    Iterating over the queue yields items until it is closed and drained.
+    """
+
+    def __init__(self, name, maxsize, policy=BLOCK, merge=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self._merge = merge or (lambda older, newer: f"{older} {newer}")
+        self._items = deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self.closed = False
+        self.dropped = 0
+        self.merged = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    async def put(self, item):
+        if self.closed:
+            return
+        if len(self._items) >= self.maxsize:
+            if self.policy == DROP_OLDEST:
+                self._items.popleft()
+                self.dropped += 1
+            elif self.policy == MERGE:
+                self._items[-1] = self._merge(self._items[-1], item)
+                self.merged += 1
+                return
+            else:
+                while len(self._items) >= self.maxsize and not self.closed:
+                    self._not_full.clear()
+                    await self._not_full.wait()
+                if self.closed:
+                    return
+        self._items.append(item)
+        self._not_empty.set()
+
+    async def get(self):
+        """Next item, or None once the queue is closed and empty"""
+        while not self._items:
+            if self.closed:
+                return None
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        item = self._items.popleft()
+        self._not_full.set()
+        return item
+
+    def items(self):
+        """Snapshot of the queued items, oldest first"""
+        return list(self._items)
+
+    def resize(self, maxsize):
+        """Change the capacity; a DROP_OLDEST queue sheds its oldest items right away"""
+        self.maxsize = maxsize
+        if self.policy == DROP_OLDEST:
+            while len(self._items) > maxsize:
+                self._items.popleft()
+                self.dropped += 1
+        if len(self._items) < maxsize:
+            self._not_full.set()
+
+    def close(self):
+        self.closed = True
+        self._not_empty.set()
+        self._not_full.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    def stats(self):
+        return {"depth": len(self._items), "dropped": self.dropped, "merged": self.merged}
+
+async def supervise(name, stage, max_restarts=5, backoff=1.0, max_backoff=30.0, reset_after=60.0):
+    """Run a stage coroutine function, restarting it with exponential backoff if it crashes.
+
+    Returns when the stage returns normally. Gives up (and re-raises) after
+    max_restarts consecutive crashes; a run longer than reset_after seconds
+    resets the count.
+    """
+    restarts = 0
+    delay = backoff
+    while True:
+        started = time.monotonic()
+        try:
+            return await stage()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if time.monotonic() - started > reset_after:
+                restarts = 0
+                delay = backoff
+            restarts += 1
+            if restarts > max_restarts:
+                print(f"Stage {name} failed {restarts} times in a row, giving up: {e}")
+                raise
+            print(f"Stage {name} crashed ({e}), restarting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_backoff)
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import sys
+import time
+from typing import Dict, List
+import metrics
+
+# How often load is measured and at most one stream changes level
+QUALITY_INTERVAL = float(os.getenv("QUALITY_INTERVAL", "5"))
+# Model busy share (over all workers) above which streams are degraded ...
+QUALITY_DEGRADE_UTILIZATION = float(os.getenv("QUALITY_DEGRADE_UTILIZATION", "0.9"))
+# ... and below which, for QUALITY_RESTORE_AFTER intervals in a row, one is restored
+QUALITY_RESTORE_UTILIZATION = float(os.getenv("QUALITY_RESTORE_UTILIZATION", "0.6"))
+QUALITY_RESTORE_AFTER = int(os.getenv("QUALITY_RESTORE_AFTER", "3"))
+# A stream with more untranscribed audio than this is falling behind real time
+QUALITY_MAX_BACKLOG = float(os.getenv("QUALITY_MAX_BACKLOG", "5"))
+# Ladder of presets, cheapest last; each level includes the knobs of the levels before it
+QUALITY_POLICY = os.getenv("QUALITY_POLICY", "full,greedy,strict_vad,fallback_model,best_effort")
+
+QUALITY_PRESETS = {
+    "full": {},
+    # Greedy decoding; left out of the ladder when WHISPER_BEAM_SIZE is already 1
+    "greedy": {"beam_size": 1},
+    # Skip quieter and shorter speech
+    "strict_vad": {"vad_start_db_boost": 6.0, "vad_min_speech_ms": 500},
+    # Decode with WHISPER_FALLBACK_MODEL; skipped when none is configured
+    "fallback_model": {"fallback_model": True},
+    # Keep only the newest speech: latency over completeness
+    "best_effort": {"speech_queue_size": 2},
+}
+
+def build_ladder(policy=QUALITY_POLICY):
+    """[(name, cumulative knobs)] for each level of the policy; levels that would change nothing are left out"""
+    from whisper_transcriber import WHISPER_BEAM_SIZE, WHISPER_FALLBACK_MODEL
+    # What each knob amounts to when no level sets it; asking for an unconfigured fallback model changes nothing
+    defaults = {"beam_size": WHISPER_BEAM_SIZE, "fallback_model": not WHISPER_FALLBACK_MODEL}
+    ladder = []
+    knobs = {}
+    for name in (n.strip() for n in policy.split(",")):
+        if name not in QUALITY_PRESETS:
+            raise ValueError(f"Unknown quality preset: {name}")
+        new_knobs = {**knobs, **QUALITY_PRESETS[name]}
+        if ladder and {**defaults, **new_knobs} == {**defaults, **knobs}:
+            continue
+        knobs = new_knobs
+        ladder.append((name, knobs))
+    return ladder
+
+class QualityController:
+    """Trades transcription quality for throughput when the model cannot keep up.
+
+    Every interval it measures model utilization (busy time over wall time
+    of all workers) and each stream's backlog of untranscribed audio. Under
+    pressure one stream moves one level down the ladder. A stream that is
+    falling behind goes first; otherwise the stream with the fewest
+    subscribed guilds does. Once there has been headroom for a few
+    intervals in a row, the most-watched degraded stream moves back up.
+    Changing at most one stream per interval gives each step time to show
+    its effect and keeps the levels from oscillating.
+    """
+
+    def __init__(self, hub, interval=QUALITY_INTERVAL, policy=QUALITY_POLICY):
+        self.hub = hub
+        self.interval = interval
+        self.ladder = build_ladder(policy)
+        # {video_id: level index}
+        self.levels: Dict[str, int] = {}
+        self.utilization = 0.0
+        self._calm = 0
+        self._last = None  # (monotonic time, scheduler busy seconds)
+        self._task = None
+        metrics.registry.add_collector(self.collect_metrics)
+
+    def level_name(self, video_id):
+        return self.ladder[self.levels.get(video_id, 0)][0]
+
+    def describe(self, video_id):
+        """Short level description for /status"""
+        level = self.levels.get(video_id, 0)
+        return f"level {level}/{len(self.ladder) - 1} ({self.ladder[level][0]}), model {self.utilization:.0%} busy"
+
+    def _measure_utilization(self):
+        whisper_transcriber = sys.modules.get("whisper_transcriber")
+        scheduler = whisper_transcriber and whisper_transcriber.get_scheduler(create=False)
+        if scheduler is None:
+            return 0.0
+        now = time.monotonic()
+        last, self._last = self._last, (now, scheduler.busy_seconds)
+        if last is None or now <= last[0]:
+            return self.utilization
+        return (scheduler.busy_seconds - last[1]) / ((now - last[0]) * scheduler.workers)
+
+    def _set_level(self, video_id, level, reason):
+        pipeline = self.hub.pipelines.get(video_id)
+        if pipeline is None:
+            return
+        print(f"Quality for {video_id}: {self.level_name(video_id)} -> {self.ladder[level][0]} ({reason})")
+        self.levels[video_id] = level
+        pipeline.apply_quality(self.ladder[level][1])
+
+    def evaluate(self):
+        """One control step; returns the video ID whose level changed, if any"""
+        self.utilization = self._measure_utilization()
+        pipelines = self.hub.pipelines
+        # Forget streams that ended
+        for video_id in [v for v in self.levels if v not in pipelines]:
+            del self.levels[video_id]
+        if not pipelines:
+            return None
+        backlog = {video_id: p.backlog_seconds() for video_id, p in pipelines.items()}
+        top = len(self.ladder) - 1
+
+        behind = [v for v, seconds in backlog.items() if seconds > QUALITY_MAX_BACKLOG]
+        if behind or self.utilization > QUALITY_DEGRADE_UTILIZATION:
+            self._calm = 0
+            candidates: List[str] = [v for v in (behind or pipelines) if self.levels.get(v, 0) < top]
+            if not candidates:
+                return None
+            # Most behind first, then the least-watched stream
+            video_id = max(candidates, key=lambda v: (backlog[v] > QUALITY_MAX_BACKLOG,
+                                                      -len(pipelines[v].subscribers), backlog[v]))
+            self._set_level(video_id, self.levels.get(video_id, 0) + 1,
+                            f"model {self.utilization:.0%} busy, backlog {backlog[video_id]:.1f}s")
+            return video_id
+
+        headroom = (self.utilization < QUALITY_RESTORE_UTILIZATION
+                    and all(seconds < QUALITY_MAX_BACKLOG / 2 for seconds in backlog.values()))
+        self._calm = self._calm + 1 if headroom else 0
+        degraded = [v for v in pipelines if self.levels.get(v, 0) > 0]
+        if self._calm < QUALITY_RESTORE_AFTER or not degraded:
+            return None
+        self._calm = 0
+        video_id = max(degraded, key=lambda v: len(pipelines[v].subscribers))
+        self._set_level(video_id, self.levels[video_id] - 1, f"model {self.utilization:.0%} busy")
+        return video_id
+
+    def collect_metrics(self):
+        for video_id in self.hub.pipelines:
+            metrics.quality_level.labels(video_id).set(self.levels.get(video_id, 0))
+        # Series of ended streams are dropped by StreamPipeline.clear_metrics
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.evaluate()
+            except Exception as e:
+                print(f"Quality controller step failed: {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set
+
+SETTINGS_DB_PATH = os.getenv("SETTINGS_DB_PATH", "guild_settings.db")
+# Slash-command updates are written to disk at most this often
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("SETTINGS_FLUSH_INTERVAL", "1.0"))
+
+class GuildSettingsStore:
+    """Guild settings persisted in SQLite (WAL mode) behind an in-memory cache.
+
+    Everything is loaded with one query at startup and reads are served
+    from the cache. Writes update the cache immediately and are flushed
+    to disk in batches on a background thread (write-behind).
+    """
+
+    def __init__(self, path=SETTINGS_DB_PATH, flush_interval=SETTINGS_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER PRIMARY KEY, settings TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        # {guild_id: {"holodex_channel_id": str, "output_channel_id": int}}
+        self.cache: Dict[int, dict] = {
+            guild_id: json.loads(settings)
+            for guild_id, settings in self._conn.execute("SELECT guild_id, settings FROM guild_settings")
+        }
+        self._dirty: Set[int] = set()
+        # One writer thread keeps SQLite access serialized
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="settings")
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def get(self, guild_id) -> dict:
+        return self.cache.get(guild_id, {})
+
+    def guild_ids(self):
+        return list(self.cache)
+
+    def set(self, guild_id, key, value):
+        self.cache.setdefault(guild_id, {})[key] = value
+        self._mark_dirty(guild_id)
+
+    def delete(self, guild_id):
+        self.cache.pop(guild_id, None)
+        self._mark_dirty(guild_id)
+
+    def _mark_dirty(self, guild_id):
+        self._dirty.add(guild_id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, shutdown): write through
+            self.flush()
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Keep going while anything is dirty: a set() during a write finds this task still running
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            # Snapshot on the event loop thread; only the SQLite write runs in the background
+            rows = self._take_dirty()
+            if not await asyncio.get_running_loop().run_in_executor(self._executor, self._write, rows):
+                # Back on the loop thread: mark them again for the next round
+                self._dirty.update(guild_id for guild_id, _ in rows)
+
+    def _take_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        return [
+            (guild_id, json.dumps(self.cache[guild_id]) if guild_id in self.cache else None)
+            for guild_id in dirty
+        ]
+
+    def _write(self, rows):
+        """Write rows in one transaction; returns whether they were saved"""
+        if not rows:
+            return True
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO guild_settings (guild_id, settings) VALUES (?, ?) "
+                    "ON CONFLICT(guild_id) DO UPDATE SET settings = excluded.settings",
+                    [(guild_id, settings) for guild_id, settings in rows if settings is not None],
+                )
+                self._conn.executemany(
+                    "DELETE FROM guild_settings WHERE guild_id = ?",
+                    [(guild_id,) for guild_id, settings in rows if settings is None],
+                )
+        except sqlite3.Error as e:
+            print(f"Failed to save guild settings: {e}")
+            return False
+        return True
+
+    def flush(self):
+        """Write every changed guild in one transaction"""
+        rows = self._take_dirty()
+        if not self._write(rows):
+            # Try again on the next flush
+            self._dirty.update(guild_id for guild_id, _ in rows)
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        rows = self._take_dirty()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, rows)
+        self._conn.close()
+        self._executor.shutdown()
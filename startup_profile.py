@@ -0,0 +1,152 @@
+# Startup profiler for the bot process: import time per module, time to ready, and the background prewarm
+# Cold starts are measured in fresh interpreters, so the numbers match what `python main.py` pays
+#
+#   python startup_profile.py                  # report
+#   python startup_profile.py --budget 0.8     # also exit 1 if time to ready exceeds 0.8 s
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+# Time to ready (seconds) that tests/test_startup_budget.py holds every cold start to
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "1.0"))
+
+# Must never be imported before the gateway is ready; prewarm() loads them afterwards
+HEAVY_MODULES = ["numpy", "yt_dlp", "faster_whisper", "ctranslate2"]
+
+# Runs in a fresh interpreter under -X importtime: everything main() does before it connects to Discord
+COLD_START = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.setup()
+from discord_bot import DiscordBot, setup_commands
+bot = DiscordBot(main.DISCORD_TOKEN)
+setup_commands(bot)
+ready = time.perf_counter()
+lazy = main.PREWARM_MODULES + sys.argv[1:]
+print(json.dumps({
+    "import": imported - started,
+    "setup": ready - imported,
+    "eager": [name for name in lazy if name in sys.modules],
+}))
+"""
+
+def parse_importtime(stderr) -> List[Tuple[str, int, int]]:
+    """[(module with nesting indent, self us, cumulative us)] from -X importtime output, in print order"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.rstrip()[1:], int(self_us), int(cumulative_us)))
+    return rows
+
+def imported_after(rows, module="main"):
+    """[(name, cumulative us)] of top-level imports that came after module, e.g. those main() makes, heaviest first"""
+    names = [name for name, _, _ in rows]
+    if module not in names:
+        return []
+    later = rows[names.index(module) + 1:]
+    return sorted(((name, cumulative) for name, _, cumulative in later if not name.startswith(" ")), key=lambda item: -item[1])
+
+def direct_imports(rows, module="main"):
+    """(module's cumulative us, [(name, cumulative us)] of what it imported first-hand, heaviest first)"""
+    depth = lambda name: len(name) - len(name.lstrip())
+    for index, (name, _, cumulative) in enumerate(rows):
+        if name.strip() == module:
+            break
+    else:
+        return 0, []
+    # Children are printed before their parent, one level deeper
+    children = []
+    for child, _, child_cumulative in reversed(rows[:index]):
+        if depth(child) <= depth(name):
+            break
+        if depth(child) == depth(name) + 2:
+            children.append((child.strip(), child_cumulative))
+    return cumulative, sorted(children, key=lambda item: -item[1])
+
+def cold_start(env=None):
+    """One fresh-interpreter start, with env added to the environment: (phase timings, importtime rows)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", COLD_START, *HEAVY_MODULES],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, **(env or {})},
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+def profile_prewarm(model):
+    """Seconds per prewarm step, run in this process (which has not loaded any stage yet)"""
+    import main
+    main.setup()
+
+    async def run():
+        try:
+            return await main.prewarm(model=model)
+        finally:
+            for scheduler in main.loaded_schedulers():
+                scheduler.close()
+            await main.transcripts.close()
+    return asyncio.run(run())
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Profile the bot's cold start and check it against a budget")
+    parser.add_argument("--budget", type=float, help="Exit 1 if time to ready (import + bot setup) exceeds this many seconds")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts to measure; the fastest counts")
+    parser.add_argument("--top", type=int, default=10, help="How many of main's imports to list")
+    parser.add_argument("--no-model", action="store_true", help="Skip loading the Whisper model in the prewarm step")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    starts = [cold_start() for _ in range(max(1, args.runs))]
+    phases, rows = min(starts, key=lambda start: start[0]["import"] + start[0]["setup"])
+    ready = phases["import"] + phases["setup"]
+    main_us, imports = direct_imports(rows)
+    setup_imports = imported_after(rows)
+
+    print(f"Time to ready (before the Discord gateway connects): {ready:.3f}s, best of {len(starts)}")
+    print(f"  import main   {phases['import']:.3f}s ({main_us / 1e6:.3f}s under -X importtime)")
+    for name, cumulative in imports[:args.top]:
+        print(f"    {name:<22}{cumulative / 1e6:.3f}s")
+    print(f"  bot setup     {phases['setup']:.3f}s")
+    for name, cumulative in setup_imports[:args.top]:
+        print(f"    {name:<22}{cumulative / 1e6:.3f}s")
+
+    prewarm = profile_prewarm(model=not args.no_model)
+    print(f"Prewarm after ready (in the background): {sum(prewarm.values()):.3f}s")
+    for name, seconds in prewarm.items():
+        print(f"    {name:<22}{seconds:.3f}s")
+
+    failures = []
+    if phases["eager"]:
+        failures.append(f"imported before ready: {', '.join(phases['eager'])}")
+    if args.budget is not None and ready > args.budget:
+        failures.append(f"time to ready {ready:.3f}s is over the {args.budget:.3f}s budget")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "ready_seconds": ready,
+                "phases": phases,
+                "main_imports": dict(imports),
+                "setup_imports": dict(setup_imports),
+                "prewarm": prewarm,
+                "budget": args.budget,
+                "failures": failures,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
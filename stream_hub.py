@@ -0,0 +1,294 @@
+import asyncio
+import os
+import sys
+import time
+from collections import deque, namedtuple
+from typing import Awaitable, Callable, Dict, Optional
+from audio_streamer import AudioStreamer
+from pipeline import DROP_OLDEST, MERGE, StageQueue, supervise
+from transcript_archive import TranscriptArchive
+import metrics
+
+# Length of the audio windows handed to the transcriber
+AUDIO_WINDOW_SECONDS = float(os.getenv("AUDIO_WINDOW_SECONDS", "1.0"))
+# How much unread audio the ring buffer holds before dropping the oldest
+AUDIO_BUFFER_SECONDS = float(os.getenv("AUDIO_BUFFER_SECONDS", "30"))
+# Speech segments waiting for the model; the oldest is dropped when full
+SPEECH_QUEUE_SIZE = int(os.getenv("SPEECH_QUEUE_SIZE", "8"))
+# Transcripts waiting for delivery; new text is merged into the newest entry when full
+TEXT_QUEUE_SIZE = int(os.getenv("TEXT_QUEUE_SIZE", "32"))
+
+# Coroutine used to hand a transcript to one subscribed guild: send(transcript, final=True)
+SendCallback = Callable[..., Awaitable[None]]
+
+# One speech segment from the voice gate; position is in seconds of stream audio, wall_time when it was ingested
+SpeechSegment = namedtuple("SpeechSegment", ["position", "wall_time", "audio"])
+
+class StreamPipeline:
+    """One audio ingest + one transcription for a live video, fanned out to every subscriber"""
+
+    def __init__(self, video_id, archive: Optional[TranscriptArchive] = None):
+        self.video_id = video_id
+        self.archive = archive
+        # {guild_id: send callback}
+        self.subscribers: Dict[int, SendCallback] = {}
+        self.task = None
+        # Why the pipeline stopped early, if it failed rather than reaching the end of the stream
+        self.error: Optional[Exception] = None
+        # The NumPy stages are imported on first use so the bot can log in without them
+        from pcm_buffer import PcmRingBuffer
+        from vad import VoiceActivityGate
+        self.ring = PcmRingBuffer(AUDIO_BUFFER_SECONDS)
+        self.vad = VoiceActivityGate(self.ring.sample_rate)
+        self.speech_queue = StageQueue("speech", SPEECH_QUEUE_SIZE, DROP_OLDEST)
+        self.text_queue = StageQueue("text", TEXT_QUEUE_SIZE, MERGE)
+        self.started_at = time.monotonic()
+        self.whisper_stream = None
+        # Cost knobs set by the quality controller; empty means full quality
+        self.quality = {}
+        # (stream position, wall time) of recently fed speech, to date archived transcripts
+        self._fed = deque(maxlen=16)
+        # Loads the fallback model in the background when a quality level first asks for it
+        self._fallback_task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def run(self):
+        # ingest -> ring -> segment -> speech_queue -> transcribe -> text_queue -> deliver
+        stages = [
+            asyncio.create_task(self.run_stage("ingest", self.ingest, self.ring)),
+            asyncio.create_task(self.run_stage("segment", self.segment, self.speech_queue)),
+            asyncio.create_task(self.run_stage("transcribe", self.transcribe, self.text_queue)),
+            asyncio.create_task(self.run_stage("deliver", self.deliver)),
+        ]
+        try:
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+            for stage in done:
+                if stage.exception():
+                    raise stage.exception()
+        except asyncio.CancelledError:
+            print(f"Pipeline for video {self.video_id} was cancelled")
+            raise
+        except Exception as e:
+            print(f"Pipeline for video {self.video_id} failed: {e}")
+            self.error = e
+        finally:
+            for stage in stages:
+                if not stage.done():
+                    stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            if self.archive is not None:
+                self.archive.end_stream(self.video_id)
+            print(f"Pipeline for video {self.video_id} skipped {self.vad.skipped_fraction():.0%} of audio as non-speech")
+
+    async def run_stage(self, name, stage, output=None):
+        """Run a stage under supervision; its output is closed once it is finished for good"""
+        try:
+            await supervise(f"{name}[{self.video_id}]", stage)
+        finally:
+            if output is not None:
+                # Downstream drains what is left and finishes
+                output.close()
+
+    async def ingest(self):
+        audio_streamer = AudioStreamer()
+        await audio_streamer.stream_into(self.video_id, self.ring)
+
+    async def segment(self):
+        window_samples = int(AUDIO_WINDOW_SECONDS * self.ring.sample_rate)
+        async for window in self.ring.windows(window_samples):
+            # Only speech reaches the model, cut at natural pauses
+            for segment, start in zip(self.vad.process(window), self.vad.segment_starts):
+                await self.speech_queue.put(self._speech(segment, start))
+        segment = self.vad.flush()
+        if segment is not None:
+            await self.speech_queue.put(self._speech(segment, self.vad.segment_starts[0]))
+
+    def _speech(self, audio, start):
+        sample_rate = self.ring.sample_rate
+        # The newest window was read just now, so audio `behind` seconds older was ingested that long ago
+        behind = (self.vad.samples_in - start) / sample_rate
+        return SpeechSegment(start / sample_rate, time.time() - behind, audio)
+
+    def _wall_time(self, position):
+        """Wall-clock time at which the audio at a stream position was ingested"""
+        if position is None:
+            return None
+        for fed_position, wall_time in reversed(self._fed):
+            if fed_position <= position + 1e-6:
+                return wall_time + position - fed_position
+        return None
+
+    async def transcribe(self):
+        from whisper_transcriber import STABILIZE_IDLE_FLUSH, WhisperTranscriber
+        whisper = WhisperTranscriber()
+        async with await whisper.start_streaming(label=self.video_id) as whisper_stream:
+            async def collect():
+                async for transcript in whisper_stream.get_transcripts():
+                    if self.archive is not None:
+                        position = whisper_stream.position
+                        self.archive.append(self.video_id, transcript, position, self._wall_time(position))
+                    await self.text_queue.put(transcript)
+            collector = asyncio.create_task(collect())
+            self.whisper_stream = whisper_stream
+            self._default_scheduler = whisper_stream.scheduler
+            self._apply_stream_quality()
+            stabilizing = hasattr(whisper_stream, "flush")
+            if stabilizing:
+                # Unstable text skips the queue: it is replaced, never merged
+                whisper_stream.on_partial = lambda text: self.broadcast(text, final=False)
+            try:
+                while True:
+                    try:
+                        segment = await asyncio.wait_for(
+                            self.speech_queue.get(), STABILIZE_IDLE_FLUSH if stabilizing else None
+                        )
+                    except asyncio.TimeoutError:
+                        # Nobody spoke for a while: the pending words will not change any more
+                        await whisper_stream.flush()
+                        continue
+                    if segment is None:
+                        break
+                    self._fed.append((segment.position, segment.wall_time))
+                    await whisper_stream.feed(segment.audio, segment.position)
+            except BaseException:
+                collector.cancel()
+                raise
+        # stop() has been called; wait for the last results
+        await collector
+
+    async def deliver(self):
+        async for transcript in self.text_queue:
+            await self.broadcast(transcript)
+
+    def backlog_seconds(self):
+        """Audio waiting to be transcribed: unread ring audio plus queued speech"""
+        queued = sum(len(segment.audio) for segment in self.speech_queue.items())
+        return (self.ring.available() + queued) / self.ring.sample_rate
+
+    def apply_quality(self, knobs):
+        """Apply cost knobs from the quality controller (see quality_controller.QUALITY_PRESETS)"""
+        self.quality = knobs
+        self.vad.configure(knobs.get("vad_start_db_boost", 0.0), knobs.get("vad_min_speech_ms"))
+        self.speech_queue.resize(knobs.get("speech_queue_size", SPEECH_QUEUE_SIZE))
+        self._apply_stream_quality()
+
+    def _apply_stream_quality(self):
+        if self.whisper_stream is None:
+            return
+        self.whisper_stream.beam_size = self.quality.get("beam_size")
+        fallback = None
+        if self.quality.get("fallback_model"):
+            from whisper_transcriber import get_fallback_scheduler
+            fallback = get_fallback_scheduler(create=False)
+            if fallback is None and (self._fallback_task is None or self._fallback_task.done()):
+                # Loading a model blocks for seconds; keep decoding with the current one until it is ready
+                self._fallback_task = asyncio.create_task(self._switch_to_fallback())
+        self.whisper_stream.scheduler = fallback or self._default_scheduler
+
+    async def _switch_to_fallback(self):
+        from whisper_transcriber import load_fallback_scheduler
+        try:
+            await load_fallback_scheduler()
+        except Exception as e:
+            print(f"Could not load the fallback model for {self.video_id}: {e}")
+            return
+        # The level may have been restored in the meantime
+        self._apply_stream_quality()
+
+    def collect_metrics(self):
+        metrics.queue_depth.labels(self.video_id, "ring_seconds").set(self.ring.available() / self.ring.sample_rate)
+        for queue in (self.speech_queue, self.text_queue):
+            stats = queue.stats()
+            metrics.queue_depth.labels(self.video_id, queue.name).set(stats["depth"])
+            metrics.queue_dropped.labels(self.video_id, queue.name).set(stats["dropped"])
+
+    def clear_metrics(self):
+        # Per-video series would otherwise pile up over months of streams
+        metrics.registry.forget("video", self.video_id)
+
+    def summary(self):
+        """Short human-readable health line for /status"""
+        uptime = max(time.monotonic() - self.started_at, 1e-6)
+        ingested = metrics.audio_ingested_seconds.labels(self.video_id).value
+        transcribed = metrics.audio_transcribed_seconds.labels(self.video_id).value
+        first_audio = metrics.ffmpeg_first_audio_seconds.labels(self.video_id)
+        reconnects = metrics.ingest_reconnects.labels(self.video_id).value
+        speech, text = self.speech_queue.stats(), self.text_queue.stats()
+        return (
+            f"ingest {ingested / uptime:.2f}x real time, "
+            f"first audio {first_audio.sum / max(first_audio.count, 1):.1f}s, "
+            f"{reconnects:.0f} reconnects, "
+            f"speech {self.vad.skipped_fraction():.0%} skipped, "
+            f"{transcribed:.0f}s transcribed, "
+            f"queues ring {self.ring.available() / self.ring.sample_rate:.1f}s / "
+            f"speech {speech['depth']} ({speech['dropped']} dropped) / text {text['depth']} ({text['merged']} merged)"
+        )
+
+    async def broadcast(self, transcript, final=True):
+        # Snapshot: guilds may unsubscribe while we are sending
+        for guild_id, send in list(self.subscribers.items()):
+            try:
+                await send(transcript, final)
+            except Exception as e:
+                print(f"Failed to send transcript to guild {guild_id}: {e}")
+
+class StreamHub:
+    """Reference-counted registry of pipelines keyed by live video ID"""
+
+    def __init__(self, archive: Optional[TranscriptArchive] = None):
+        self.pipelines: Dict[str, StreamPipeline] = {}
+        # Committed transcripts of every pipeline are archived here, if set
+        self.archive = archive
+        metrics.registry.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        for pipeline in self.pipelines.values():
+            pipeline.collect_metrics()
+        # Do not load the transcriber (let alone the model) just to report an empty queue
+        whisper_transcriber = sys.modules.get("whisper_transcriber")
+        scheduler = whisper_transcriber and whisper_transcriber.get_scheduler(create=False)
+        if scheduler:
+            metrics.queue_depth.labels("all", "inference").set(scheduler.queue_depth())
+
+    def acquire(self, video_id, guild_id, send: SendCallback):
+        """Subscribe a guild to a video, starting the pipeline on first use"""
+        pipeline = self.pipelines.get(video_id)
+        if pipeline is None or pipeline.task.done():
+            pipeline = StreamPipeline(video_id, self.archive)
+            self.pipelines[video_id] = pipeline
+            pipeline.start()
+            print(f"Started pipeline for video {video_id}")
+        pipeline.subscribers[guild_id] = send
+        return pipeline
+
+    async def release(self, video_id, guild_id):
+        """Unsubscribe a guild; the pipeline is torn down when nobody is left"""
+        pipeline = self.pipelines.get(video_id)
+        if pipeline is None:
+            return
+        pipeline.subscribers.pop(guild_id, None)
+        if pipeline.subscribers:
+            return
+        del self.pipelines[video_id]
+        if not pipeline.task.done():
+            print(f"Stopping pipeline for video {video_id} - no subscribers left")
+            pipeline.task.cancel()
+            try:
+                await pipeline.task
+            except asyncio.CancelledError:
+                pass
+        # After the stages are gone, so none of them recreates a series
+        pipeline.clear_metrics()
+
+    async def watch(self, video_id, guild_id, send: SendCallback):
+        """Receive transcripts for a video until its stream ends or the caller is cancelled; returns the pipeline"""
+        pipeline = self.acquire(video_id, guild_id, send)
+        try:
+            # Shield so cancelling one guild does not cancel the shared pipeline
+            await asyncio.shield(pipeline.task)
+        finally:
+            await self.release(video_id, guild_id)
+        return pipeline
@@ -0,0 +1,25 @@
+# The bot must reach the Discord login quickly, without loading NumPy, yt-dlp or the model first
+#
+#   python -m pytest tests/test_startup_budget.py     # STARTUP_BUDGET=0.8 for a tighter budget
+
+import pytest
+import startup_profile
+
+# Throwaway databases, so cold starts do not create or read the bot's own
+ENV = {"SETTINGS_DB_PATH": ":memory:", "TRANSCRIPT_DB_PATH": ":memory:"}
+# The fastest of these counts, as in startup_profile.py; a busy machine should not fail the check
+RUNS = 3
+
+@pytest.fixture(scope="module")
+def starts():
+    return [startup_profile.cold_start(ENV)[0] for _ in range(RUNS)]
+
+def test_no_heavy_module_before_ready(starts):
+    for phases in starts:
+        assert phases["eager"] == [], f"imported before ready: {', '.join(phases['eager'])}"
+
+def test_time_to_ready_within_budget(starts):
+    ready = min(phases["import"] + phases["setup"] for phases in starts)
+    assert ready <= startup_profile.STARTUP_BUDGET, (
+        f"time to ready {ready:.3f}s is over the {startup_profile.STARTUP_BUDGET:.3f}s budget"
+    )
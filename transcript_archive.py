@@ -0,0 +1,325 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+TRANSCRIPT_DB_PATH = os.getenv("TRANSCRIPT_DB_PATH", "transcripts.db")
+# Segments per compressed block (at most BLOCK_ROWS)
+TRANSCRIPT_BLOCK_SEGMENTS = int(os.getenv("TRANSCRIPT_BLOCK_SEGMENTS", "64"))
+# New segments are written and indexed at most this often
+TRANSCRIPT_FLUSH_INTERVAL = float(os.getenv("TRANSCRIPT_FLUSH_INTERVAL", "2.0"))
+# Timestamp links start this many seconds early so the words are heard from the beginning
+TRANSCRIPT_LINK_LEAD = float(os.getenv("TRANSCRIPT_LINK_LEAD", "3"))
+
+# Full-text rowid = block id * BLOCK_ROWS + index within the block
+BLOCK_ROWS = 1024
+
+# offset: seconds into the YouTube video; wall_time: Unix time the audio was ingested
+ArchivedSegment = namedtuple("ArchivedSegment", ["video_id", "offset", "wall_time", "text"])
+
+class _OpenBlock:
+    """The block of a live stream that is still being filled"""
+    __slots__ = ("block_id", "segments", "indexed")
+
+    def __init__(self, block_id):
+        self.block_id = block_id
+        # [[stream position, wall time, text], ...]
+        self.segments = []
+        # How many of the segments are already in the full-text index
+        self.indexed = 0
+
+def encode_block(segments):
+    return zlib.compress(json.dumps(segments, separators=(",", ":")).encode("utf-8"))
+
+def decode_block(data):
+    return json.loads(zlib.decompress(data))
+
+def fts_query(text):
+    """Match every word of a user query ("word*" for a prefix); None if there is nothing to search for"""
+    terms = [f'"{word}"' + ("*" if star else "") for word, star in re.findall(r"(\w+)(\*?)", text)]
+    return " ".join(terms) or None
+
+def format_offset(seconds):
+    hours, rest = divmod(int(max(seconds, 0)), 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}"
+
+def parse_offset(text):
+    """"1:02:03", "62:03" or plain seconds -> seconds"""
+    seconds = 0.0
+    for part in text.strip().split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def timestamp_link(segment: ArchivedSegment, lead=TRANSCRIPT_LINK_LEAD):
+    return f"https://youtu.be/{segment.video_id}?t={int(max(segment.offset - lead, 0))}"
+
+class TranscriptArchive:
+    """Every committed transcript segment, stored on disk for /search and /history.
+
+    Segments are kept per stream in zlib-compressed blocks of JSON rows
+    (stream position, wall time, text) in SQLite, next to a contentless
+    FTS5 index whose rowids point back into the blocks, so the text is
+    stored only once. Appends are buffered in memory and written by a
+    single background thread, at most every flush interval; the open
+    block of a live stream is rewritten until it is full. Queries flush
+    first, so they see everything committed so far.
+    """
+
+    def __init__(self, path=TRANSCRIPT_DB_PATH, flush_interval=TRANSCRIPT_FLUSH_INTERVAL,
+                 block_segments=TRANSCRIPT_BLOCK_SEGMENTS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.block_segments = min(block_segments, BLOCK_ROWS)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS streams (video_id TEXT PRIMARY KEY, channel_id TEXT, started_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS streams_channel ON streams (channel_id)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (id INTEGER PRIMARY KEY, video_id TEXT NOT NULL, "
+                "first_wall REAL NOT NULL, last_wall REAL NOT NULL, data BLOB NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS blocks_video ON blocks (video_id, first_wall)")
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5("
+                "text, content='', tokenize='unicode61 remove_diacritics 2')"
+            )
+        self._next_block_id = (self._conn.execute("SELECT MAX(id) FROM blocks").fetchone()[0] or 0) + 1
+        # {video_id: block being filled}
+        self._open: Dict[str, _OpenBlock] = {}
+        # {block_id: (video_id, block)} for blocks with segments not written yet
+        self._dirty: Dict[int, tuple] = {}
+        # {video_id: stream start (Unix time)} for streams being archived
+        self._started: Dict[str, float] = {}
+        # {video_id: (channel_id, started_at)} waiting to be written
+        self._streams: Dict[str, tuple] = {}
+        # One thread keeps SQLite access serialized
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcripts")
+        self._flush_task: Optional[asyncio.Task] = None
+        self.segments_written = 0
+
+    def register_stream(self, video_id, channel_id=None, started_at=None):
+        """Record which channel a video belongs to and when it started (for timestamp links)"""
+        if started_at:
+            self._started[video_id] = started_at
+        self._streams[video_id] = (channel_id, self._started.get(video_id))
+        self._schedule_flush()
+
+    def append(self, video_id, text, position=None, wall_time=None):
+        """Archive one committed segment; position is in seconds of stream audio"""
+        wall_time = time.time() if wall_time is None else wall_time
+        if video_id not in self._started:
+            # No start time from Holodex: offsets count from the first archived audio
+            self._started[video_id] = wall_time - (position or 0.0)
+            channel_id = self._streams.get(video_id, (None, None))[0]
+            self._streams[video_id] = (channel_id, self._started[video_id])
+        block = self._open.get(video_id)
+        if block is None or len(block.segments) >= self.block_segments:
+            block = self._open[video_id] = _OpenBlock(self._next_block_id)
+            self._next_block_id += 1
+        block.segments.append([position, wall_time, text])
+        self._dirty[block.block_id] = (video_id, block)
+        self._schedule_flush()
+
+    def end_stream(self, video_id):
+        """The stream is over: its open block is written on the next flush and then forgotten"""
+        self._open.pop(video_id, None)
+        self._started.pop(video_id, None)
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, shutdown): write through
+            self.flush()
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Keep going until nothing is pending: after a failed write (e.g. while another process holds the
+        # database lock), and for segments added during a write, which find this task still running
+        while self._dirty or self._streams:
+            await asyncio.sleep(self.flush_interval)
+            await self._write_pending()
+
+    async def _write_pending(self):
+        """Write what is pending in the background; on failure it stays pending. Returns success."""
+        pending = self._take_dirty()
+        if await self._run(self._write, pending):
+            return True
+        self._restore(pending)
+        return False
+
+    def _take_dirty(self):
+        """Snapshot pending writes: (streams, [(video_id, block, segments, indexed_from)])"""
+        streams, self._streams = self._streams, {}
+        blocks = []
+        for video_id, block in self._dirty.values():
+            blocks.append((video_id, block, list(block.segments), block.indexed))
+            block.indexed = len(block.segments)
+            if len(block.segments) >= self.block_segments and self._open.get(video_id) is block:
+                # Full: it will not change again
+                del self._open[video_id]
+        self._dirty = {}
+        return streams, blocks
+
+    def _restore(self, pending):
+        """Undo _take_dirty after a failed write, keeping anything that changed since"""
+        streams, blocks = pending
+        for video_id, stream in streams.items():
+            self._streams.setdefault(video_id, stream)
+        for video_id, block, _, indexed in blocks:
+            block.indexed = min(block.indexed, indexed)
+            self._dirty[block.block_id] = (video_id, block)
+
+    def _write(self, pending):
+        """Write a snapshot in one transaction; returns whether it was saved"""
+        streams, blocks = pending
+        if not streams and not blocks:
+            return True
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO streams (video_id, channel_id, started_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(video_id) DO UPDATE SET channel_id = COALESCE(excluded.channel_id, channel_id), "
+                    "started_at = COALESCE(started_at, excluded.started_at)",
+                    [(video_id, channel_id, started_at) for video_id, (channel_id, started_at) in streams.items()],
+                )
+                for video_id, block, segments, indexed in blocks:
+                    block_id = block.block_id
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO blocks (id, video_id, first_wall, last_wall, data) VALUES (?, ?, ?, ?, ?)",
+                        (block_id, video_id, segments[0][1], segments[-1][1], encode_block(segments)),
+                    )
+                    self._conn.executemany(
+                        "INSERT INTO segments_fts (rowid, text) VALUES (?, ?)",
+                        [(block_id * BLOCK_ROWS + i, segments[i][2]) for i in range(indexed, len(segments))],
+                    )
+        except sqlite3.Error as e:
+            print(f"Failed to save transcripts: {e}")
+            return False
+        self.segments_written += sum(len(segments) - indexed for _, _, segments, indexed in blocks)
+        return True
+
+    def flush(self):
+        pending = self._take_dirty()
+        if not self._write(pending):
+            self._restore(pending)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _query(self, func, *args):
+        # Write what is pending first (same thread, so it happens before the read)
+        if not await self._write_pending():
+            self._schedule_flush()
+        return await self._run(func, *args)
+
+    def _segments(self, video_id, started_at, rows, indices=None):
+        """Stored rows -> ArchivedSegments with offsets into the video"""
+        return [
+            ArchivedSegment(video_id, rows[i][1] - started_at, rows[i][1], rows[i][2])
+            for i in (range(len(rows)) if indices is None else indices)
+        ]
+
+    def _search(self, query, channel_id, video_id, limit):
+        sql = (
+            "SELECT f.rowid, b.video_id, b.data, COALESCE(s.started_at, b.first_wall) FROM segments_fts f "
+            f"JOIN blocks b ON b.id = f.rowid / {BLOCK_ROWS} "
+            "LEFT JOIN streams s ON s.video_id = b.video_id WHERE segments_fts MATCH ?"
+        )
+        params = [query]
+        if channel_id:
+            sql += " AND s.channel_id = ?"
+            params.append(channel_id)
+        if video_id:
+            sql += " AND b.video_id = ?"
+            params.append(video_id)
+        sql += " ORDER BY f.rowid DESC LIMIT ?"
+        params.append(limit)
+        decoded = {}
+        results = []
+        for rowid, video, data, started_at in self._conn.execute(sql, params):
+            block_id, i = divmod(rowid, BLOCK_ROWS)
+            if block_id not in decoded:
+                decoded[block_id] = decode_block(data)
+            results.extend(self._segments(video, started_at, decoded[block_id], [i]))
+        return results
+
+    async def search(self, text, channel_id=None, video_id=None, limit=10) -> List[ArchivedSegment]:
+        """Newest segments containing every word of text, optionally within one channel or video"""
+        query = fts_query(text)
+        if query is None:
+            return []
+        return await self._query(self._search, query, channel_id, video_id, limit)
+
+    def _history(self, video_id, start, end):
+        """Segments between two offsets; a negative start counts back from the last archived segment"""
+        started_at, last_wall = self._conn.execute(
+            "SELECT COALESCE((SELECT started_at FROM streams WHERE video_id = ?), MIN(first_wall)), MAX(last_wall) "
+            "FROM blocks WHERE video_id = ?", (video_id, video_id)
+        ).fetchone()
+        if last_wall is None:
+            return []
+        if start < 0:
+            start, end = last_wall - started_at + start, last_wall - started_at
+        # Only blocks overlapping the range are decompressed
+        rows = self._conn.execute(
+            "SELECT data FROM blocks WHERE video_id = ? AND first_wall <= ? AND last_wall >= ? ORDER BY first_wall",
+            (video_id, started_at + end, started_at + start),
+        )
+        segments = [s for (data,) in rows for s in self._segments(video_id, started_at, decode_block(data))]
+        return [s for s in segments if start <= s.offset <= end]
+
+    async def history(self, video_id, start=None, duration=300.0) -> List[ArchivedSegment]:
+        """`duration` seconds of a video from offset `start`, or its final `duration` seconds"""
+        if start is None:
+            return await self._query(self._history, video_id, -duration, 0.0)
+        return await self._query(self._history, video_id, start, start + duration)
+
+    def _latest_video(self, channel_id):
+        row = self._conn.execute(
+            "SELECT b.video_id FROM blocks b JOIN streams s ON s.video_id = b.video_id "
+            "WHERE s.channel_id = ? ORDER BY b.id DESC LIMIT 1", (channel_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    async def latest_video(self, channel_id) -> Optional[str]:
+        """The most recent archived video of a channel"""
+        return await self._query(self._latest_video, channel_id)
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+        self._conn.close()
+        self._executor.shutdown()
+
+def format_segments(segments: List[ArchivedSegment], max_chars=1900):
+    """Discord lines with timestamp links, cut to fit one message"""
+    lines = []
+    length = 0
+    video_id = None
+    several = len({segment.video_id for segment in segments}) > 1
+    for segment in segments:
+        if several and segment.video_id != video_id:
+            video_id = segment.video_id
+            lines.append(f"**`{video_id}`**")
+        text = segment.text if len(segment.text) <= 300 else segment.text[:299] + "…"
+        lines.append(f"[`{format_offset(segment.offset)}`](<{timestamp_link(segment)}>) {text}")
+        length += len(lines[-1]) + 1
+        if length > max_chars:
+            lines[-1] = "…"
+            break
+    return "\n".join(lines)
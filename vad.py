@@ -0,0 +1,207 @@
+import os
+import numpy as np
+
+SAMPLE_RATE = 16000
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "30"))
+# Speech starts this far above the noise floor and ends below the lower threshold (hysteresis)
+VAD_START_DB = float(os.getenv("VAD_START_DB", "12"))
+VAD_STOP_DB = float(os.getenv("VAD_STOP_DB", "6"))
+# Keep a segment open through short pauses
+VAD_HANGOVER_MS = int(os.getenv("VAD_HANGOVER_MS", "400"))
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "250"))
+VAD_MAX_SEGMENT_SECONDS = float(os.getenv("VAD_MAX_SEGMENT_SECONDS", "6"))
+
+# Anything quieter than this is silence no matter what the noise floor says
+ABSOLUTE_FLOOR_DB = -60.0
+# Share of spectral energy in the 100-4000 Hz voice band a speech frame needs
+MIN_VOICE_BAND_RATIO = 0.6
+# Frames flatter than this (hiss, wind, white-ish noise) are never speech
+MAX_SPECTRAL_FLATNESS = 0.5
+# How fast the noise floor creeps up towards sustained loud audio such as BGM
+NOISE_FLOOR_RISE_DB_PER_S = 0.5
+PREROLL_MS = 150
+
+class VoiceActivityGate:
+    """Drops silence and music-only audio and cuts speech at natural pauses.
+
+    Frame features (energy, voice-band ratio, spectral flatness) are computed
+    for a whole window at once with NumPy; only the small hysteresis state
+    machine runs per frame. process() returns the speech segments that were
+    finished by the given window; segment_starts holds their start sample
+    positions in the input stream.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, frame_ms=VAD_FRAME_MS, start_db=VAD_START_DB,
+                 stop_db=VAD_STOP_DB, hangover_ms=VAD_HANGOVER_MS, min_speech_ms=VAD_MIN_SPEECH_MS,
+                 max_segment_seconds=VAD_MAX_SEGMENT_SECONDS):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_len = int(sample_rate * frame_ms / 1000)
+        self.start_db = start_db
+        self._default_start_db = start_db
+        self._default_min_speech_ms = min_speech_ms
+        self.stop_db = stop_db
+        self.hangover_frames = max(1, hangover_ms // frame_ms)
+        self.min_speech_frames = max(1, min_speech_ms // frame_ms)
+        self.preroll_frames = PREROLL_MS // frame_ms
+        self.floor_rise = NOISE_FLOOR_RISE_DB_PER_S * frame_ms / 1000
+
+        self._window = np.hanning(self.frame_len).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.frame_len, 1 / sample_rate)
+        self._voice_band = (freqs >= 100) & (freqs <= 4000)
+
+        self._carry = np.zeros(self.frame_len, dtype=np.float32)
+        self._carry_len = 0
+        max_frames = int(max_segment_seconds * sample_rate) // self.frame_len
+        self._segment = np.zeros(max_frames * self.frame_len, dtype=np.float32)
+        self._segment_energy = np.zeros(max_frames, dtype=np.float32)
+        self._segment_frames = 0
+        self._preroll = np.zeros((self.preroll_frames, self.frame_len), dtype=np.float32)
+        self._preroll_count = 0
+
+        self._noise_floor = None
+        self._active = False
+        self._silent_run = 0
+        self._speech_frames = 0
+
+        self.samples_in = 0
+        self.samples_passed = 0
+        self._frames_seen = 0
+        # Stream sample position of each segment returned by the last process()/flush()
+        self.segment_starts = []
+
+    def _features(self, frames):
+        energy_db = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+        power = np.square(np.abs(np.fft.rfft(frames * self._window, axis=1))) + 1e-12
+        voice_ratio = power[:, self._voice_band].sum(axis=1) / power.sum(axis=1)
+        flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+        return energy_db, voice_ratio, flatness
+
+    def _frames(self, window):
+        """Split carried-over samples + window into whole frames; keep the remainder for next time"""
+        if self._carry_len:
+            need = self.frame_len - self._carry_len
+            head = np.concatenate((self._carry[:self._carry_len], window[:need]))
+            window = window[need:]
+        else:
+            head = None
+        n = len(window) // self.frame_len
+        frames = window[:n * self.frame_len].reshape(n, self.frame_len)
+        rest = window[n * self.frame_len:]
+        if head is not None:
+            if len(head) == self.frame_len:
+                frames = np.concatenate((head[np.newaxis], frames))
+                self._carry_len = 0
+            else:
+                # Window was shorter than what the carry needed
+                self._carry[:len(head)] = head
+                self._carry_len = len(head)
+                return frames[:0]
+        self._carry[:len(rest)] = rest
+        self._carry_len = len(rest)
+        return frames
+
+    def _append(self, frame, energy):
+        start = self._segment_frames * self.frame_len
+        self._segment[start:start + self.frame_len] = frame
+        self._segment_energy[self._segment_frames] = energy
+        self._segment_frames += 1
+
+    def _take_segment(self, n_frames):
+        """Emit the first n_frames of the open segment and keep the rest open"""
+        n_samples = n_frames * self.frame_len
+        # The open segment ends with the frame just processed (preroll frames directly precede it)
+        self.segment_starts.append((self._frames_seen - self._segment_frames) * self.frame_len)
+        segment = self._segment[:n_samples].copy()
+        remaining = self._segment_frames - n_frames
+        if remaining:
+            self._segment[:remaining * self.frame_len] = self._segment[n_samples:self._segment_frames * self.frame_len]
+            self._segment_energy[:remaining] = self._segment_energy[n_frames:self._segment_frames]
+        self._segment_frames = remaining
+        self.samples_passed += len(segment)
+        return segment
+
+    def _end_segment(self, out):
+        # Trailing hangover frames are silence; do not send them to the model
+        frames = self._segment_frames - min(self._silent_run, self._segment_frames)
+        if self._speech_frames >= self.min_speech_frames and frames:
+            out.append(self._take_segment(frames))
+        self._segment_frames = 0
+        self._active = False
+        self._silent_run = 0
+        self._speech_frames = 0
+
+    def process(self, window):
+        self.samples_in += len(window)
+        self.segment_starts = []
+        frames = self._frames(np.asarray(window, dtype=np.float32))
+        if not len(frames):
+            return []
+        energy_db, voice_ratio, flatness = self._features(frames)
+        voiced = (voice_ratio >= MIN_VOICE_BAND_RATIO) & (flatness <= MAX_SPECTRAL_FLATNESS)
+
+        out = []
+        for i in range(len(frames)):
+            self._frames_seen += 1
+            energy = energy_db[i]
+            if self._noise_floor is None or energy < self._noise_floor:
+                self._noise_floor = energy
+            else:
+                self._noise_floor += self.floor_rise
+            above = energy - max(self._noise_floor, ABSOLUTE_FLOOR_DB)
+
+            if not self._active:
+                if voiced[i] and above >= self.start_db:
+                    self._active = True
+                    # Prepend a little audio so word onsets are not clipped
+                    for j in range(self._preroll_count):
+                        self._append(self._preroll[j], ABSOLUTE_FLOOR_DB)
+                    self._preroll_count = 0
+                else:
+                    self._push_preroll(frames[i])
+                    continue
+            self._append(frames[i], energy)
+            if voiced[i] and above >= self.stop_db:
+                self._speech_frames += 1
+                self._silent_run = 0
+            else:
+                self._silent_run += 1
+                if self._silent_run >= self.hangover_frames:
+                    self._end_segment(out)
+                    continue
+            if self._segment_frames == len(self._segment_energy):
+                out.append(self._take_segment(self._pause_cut()))
+        return out
+
+    def _push_preroll(self, frame):
+        if not self.preroll_frames:
+            return
+        if self._preroll_count == self.preroll_frames:
+            self._preroll[:-1] = self._preroll[1:]
+            self._preroll_count -= 1
+        self._preroll[self._preroll_count] = frame
+        self._preroll_count += 1
+
+    def _pause_cut(self):
+        """Segment is full: cut at the quietest frame in its second half"""
+        half = self._segment_frames // 2
+        return half + int(np.argmin(self._segment_energy[half:self._segment_frames])) + 1
+
+    def configure(self, start_db_boost=0.0, min_speech_ms=None):
+        """Make the gate stricter on the fly (skips more quiet or short speech); no arguments restore the defaults"""
+        self.start_db = self._default_start_db + start_db_boost
+        min_speech_ms = self._default_min_speech_ms if min_speech_ms is None else min_speech_ms
+        self.min_speech_frames = max(1, min_speech_ms // self.frame_ms)
+
+    def flush(self):
+        """End of stream: return the open speech segment, if any"""
+        out = []
+        self.segment_starts = []
+        if self._active:
+            self._end_segment(out)
+        return out[0] if out else None
+
+    def skipped_fraction(self):
+        if not self.samples_in:
+            return 0.0
+        return 1.0 - self.samples_passed / self.samples_in
@@ -1,43 +1,550 @@
 import asyncio
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import numpy as np
+import metrics
+
+# "faster-whisper" for the real CPU model, "stub" for the deterministic stand-in
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "faster-whisper")
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "small")
+# Smaller model streams may be switched to under load (see quality_controller.py); empty disables it
+WHISPER_FALLBACK_MODEL = os.getenv("WHISPER_FALLBACK_MODEL", "")
+WHISPER_LANGUAGE = os.getenv("WHISPER_LANGUAGE", "en")
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "1"))
+# Intra-op threads per model instance; 0 lets CTranslate2 decide
+WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", "0"))
+# Batching knobs: larger batches and longer delays trade latency for throughput
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "4"))
+INFERENCE_MAX_DELAY = float(os.getenv("INFERENCE_MAX_DELAY", "0.2"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+# Re-decode the uncommitted audio with every new speech segment and only commit words two hypotheses agree on
+WHISPER_STABILIZE = os.getenv("WHISPER_STABILIZE", "0") == "1"
+# Uncommitted audio is force-committed beyond this, which bounds the cost of every decode
+STABILIZE_MAX_BUFFER_SECONDS = float(os.getenv("STABILIZE_MAX_BUFFER_SECONDS", "15"))
+# Commit the pending tail when no new speech arrived for this long
+STABILIZE_IDLE_FLUSH = float(os.getenv("STABILIZE_IDLE_FLUSH", "1.0"))
+
+SAMPLE_RATE = 16000
+
+# Times are in seconds relative to the start of the window
+Segment = namedtuple("Segment", ["start", "end", "text"])
+# Times are in seconds on the stream's speech timeline
+Word = namedtuple("Word", ["start", "end", "text"])
+
+class WhisperBackend:
+    """Model interface. transcribe_batch runs in a worker thread, never on the event loop."""
+
+    def transcribe_batch(self, windows: List[np.ndarray], beam_size=None) -> List[List[Segment]]:
+        """beam_size overrides the backend's default for this batch (quality control)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class StubBackend(WhisperBackend):
+    """Deterministic stand-in for tests: one segment per window describing its length and level"""
+
+    def transcribe_batch(self, windows, beam_size=None):
+        results = []
+        for window in windows:
+            duration = len(window) / SAMPLE_RATE
+            rms = float(np.sqrt(np.mean(np.square(window)))) if len(window) else 0.0
+            results.append([Segment(0.0, duration, f"[{duration:.2f}s rms={rms:.3f}]")])
+        return results
+
+class FasterWhisperBackend(WhisperBackend):
+    """CPU backend on faster-whisper/CTranslate2.
+
+    Every window is padded to Whisper's 30 s input and the whole batch is
+    decoded with one generate() call.
+    """
+
+    def __init__(self, model_size=WHISPER_MODEL, language=WHISPER_LANGUAGE, beam_size=WHISPER_BEAM_SIZE,
+                 cpu_threads=WHISPER_CPU_THREADS):
+        from faster_whisper import WhisperModel
+        from faster_whisper.tokenizer import Tokenizer
+        self.model = WhisperModel(
+            model_size, device="cpu", compute_type="int8", cpu_threads=cpu_threads, num_workers=INFERENCE_WORKERS
+        )
+        self.tokenizer = Tokenizer(
+            self.model.hf_tokenizer, self.model.model.is_multilingual, task="transcribe", language=language
+        )
+        self.beam_size = beam_size
+
+    def _features(self, window):
+        features = self.model.feature_extractor(window)
+        n_frames = self.model.feature_extractor.nb_max_frames
+        if features.shape[-1] < n_frames:
+            return np.pad(features, ((0, 0), (0, n_frames - features.shape[-1])))
+        return features[:, :n_frames]
+
+    def _segments(self, tokens, duration):
+        # Whisper brackets each segment with timestamp tokens: <|0.00|> text <|2.40|>
+        timestamp_begin = self.tokenizer.timestamp_begin
+        segments = []
+        start = None
+        text_tokens = []
+        for token in tokens:
+            if token >= timestamp_begin:
+                time = (token - timestamp_begin) * 0.02
+                if start is None or not text_tokens:
+                    start = time
+                else:
+                    segments.append(Segment(start, time, self.tokenizer.decode(text_tokens).strip()))
+                    start = None
+                    text_tokens = []
+            elif token < self.tokenizer.eot:
+                text_tokens.append(token)
+        if text_tokens:
+            segments.append(Segment(start or 0.0, duration, self.tokenizer.decode(text_tokens).strip()))
+        return [s for s in segments if s.text]
+
+    def transcribe_batch(self, windows, beam_size=None):
+        import ctranslate2
+        features = np.ascontiguousarray(np.stack([self._features(w) for w in windows]))
+        prompt = list(self.tokenizer.sot_sequence)
+        results = self.model.model.generate(
+            ctranslate2.StorageView.from_array(features),
+            [prompt] * len(windows),
+            beam_size=beam_size or self.beam_size,
+            max_length=448,
+        )
+        return [
+            self._segments(result.sequences_ids[0], len(window) / SAMPLE_RATE)
+            for result, window in zip(results, windows)
+        ]
+
+def create_backend(name=WHISPER_BACKEND, cpu_threads=WHISPER_CPU_THREADS, model_size=WHISPER_MODEL) -> WhisperBackend:
+    if name == "stub":
+        return StubBackend()
+    if name == "faster-whisper":
+        return FasterWhisperBackend(model_size, cpu_threads=cpu_threads)
+    raise ValueError(f"Unknown Whisper backend: {name}")
+
+class InferenceScheduler:
+    """Gathers pending windows from every active stream and runs them as batches.
+
+    A batch is dispatched once it holds max_batch windows or its oldest
+    window has waited max_delay seconds. At most `workers` batches run at
+    the same time; results are routed back to each submitter's future.
+    """
+
+    def __init__(self, backend: WhisperBackend, max_batch=INFERENCE_MAX_BATCH,
+                 max_delay=INFERENCE_MAX_DELAY, workers=INFERENCE_WORKERS):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whisper")
+        self._slots = asyncio.Semaphore(workers)
+        self._task: Optional[asyncio.Task] = None
+        self._running_batches = set()
+        self.workers = workers
+        self.batches_run = 0
+        self.windows_run = 0
+        # Running totals of model wall time and audio decoded, for utilization and RTF over any interval
+        self.busy_seconds = 0.0
+        self.audio_seconds = 0.0
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, window, label=None, beam_size=None) -> List[Segment]:
+        """Transcribe one window; label (the video ID) is only used for metrics"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((window, future, beam_size))
+        segments = await future
+        if label is not None:
+            metrics.audio_transcribed_seconds.labels(label).inc(len(window) / SAMPLE_RATE)
+        return segments
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Submitters that gave up do not need a slot in the batch
+        return [item for item in batch if not item[1].done()]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            if not batch:
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._run_batch(batch))
+            self._running_batches.add(task)
+            task.add_done_callback(self._running_batches.discard)
+
+    def _transcribe_groups(self, batch):
+        """Windows asking for the same beam size share one backend call"""
+        results = [None] * len(batch)
+        groups = {}
+        for i, (_, _, beam_size) in enumerate(batch):
+            groups.setdefault(beam_size, []).append(i)
+        for beam_size, indices in groups.items():
+            windows = [batch[i][0] for i in indices]
+            if beam_size is None:
+                segments = self.backend.transcribe_batch(windows)
+            else:
+                segments = self.backend.transcribe_batch(windows, beam_size=beam_size)
+            for i, result in zip(indices, segments):
+                results[i] = result
+        return results
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            started = time.perf_counter()
+            results = await loop.run_in_executor(self._executor, self._transcribe_groups, batch)
+            elapsed = time.perf_counter() - started
+            audio_seconds = sum(len(window) for window, _, _ in batch) / SAMPLE_RATE
+            self.busy_seconds += elapsed
+            self.audio_seconds += audio_seconds
+            metrics.whisper_batch_seconds.observe(elapsed)
+            if audio_seconds:
+                metrics.whisper_batch_rtf.observe(elapsed / audio_seconds)
+            for (_, future, _), segments in zip(batch, results):
+                if not future.done():
+                    future.set_result(segments)
+            self.batches_run += 1
+            self.windows_run += len(batch)
+        except Exception as e:
+            print(f"Whisper batch of {len(batch)} failed: {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.backend.close()
+
+_scheduler: Optional[InferenceScheduler] = None
+
+def get_scheduler(create=True) -> Optional[InferenceScheduler]:
+    """The process-wide scheduler; one shared instance is what makes cross-stream batching work"""
+    global _scheduler
+    if _scheduler is None and create:
+        _scheduler = _create_scheduler()
+    return _scheduler
+
+def _create_scheduler() -> InferenceScheduler:
+    from worker_pool import INFERENCE_PROCESSES, ProcessPoolBackend
+    if INFERENCE_PROCESSES > 0:
+        # One feeder thread per worker process keeps every process busy
+        return InferenceScheduler(ProcessPoolBackend(INFERENCE_PROCESSES), workers=INFERENCE_PROCESSES)
+    return InferenceScheduler(create_backend())
+
+# {scheduler name: executor future of the load in progress}
+_loading: Dict[str, asyncio.Future] = {}
+
+async def _load_once(name, load):
+    """Run load() off the event loop; concurrent callers for the same name share one load"""
+    future = _loading.get(name)
+    if future is None or future.done():
+        future = _loading[name] = asyncio.get_running_loop().run_in_executor(None, load)
+    # Shield so a cancelled caller does not cancel the load for everyone else waiting on it
+    await asyncio.shield(future)
+
+async def load_scheduler() -> InferenceScheduler:
+    """get_scheduler() with the model loaded off the event loop, so the first stream does not stall the bot"""
+    if _scheduler is None:
+        await _load_once("main", get_scheduler)
+    return _scheduler
+
+_fallback_scheduler: Optional[InferenceScheduler] = None
+
+def get_fallback_scheduler(create=True) -> Optional[InferenceScheduler]:
+    """Scheduler around WHISPER_FALLBACK_MODEL, or None if no fallback model is configured"""
+    global _fallback_scheduler
+    if _fallback_scheduler is None and create and WHISPER_FALLBACK_MODEL:
+        _fallback_scheduler = InferenceScheduler(create_backend(model_size=WHISPER_FALLBACK_MODEL))
+    return _fallback_scheduler
+
+async def load_fallback_scheduler() -> Optional[InferenceScheduler]:
+    """get_fallback_scheduler() with the model loaded off the event loop; concurrent callers share one load"""
+    if _fallback_scheduler is None and WHISPER_FALLBACK_MODEL:
+        await _load_once("fallback", get_fallback_scheduler)
+    return _fallback_scheduler
+
+def set_scheduler(scheduler: InferenceScheduler):
+    """Replace the process-wide scheduler, e.g. with one around a different backend"""
+    global _scheduler
+    _scheduler = scheduler
+
+class WhisperStream:
+    def __init__(self, scheduler: InferenceScheduler, max_pending=2, label=None):
+        self.scheduler = scheduler
+        self.label = label
+        self.beam_size = None  # Overrides the backend default, e.g. when the quality controller degrades
+        self.max_pending = max_pending
+        # Stream position (seconds) of the transcript get_transcripts() yielded last, if the feeder gave one
+        self.position = None
+        # (inference result, stream position) in feed order
+        self._pending = deque()
+        self._ready = asyncio.Event()
+        self._running = True
+
+    async def feed(self, audio_chunk, position=None):
+        # The ring buffer reuses its memory once we return, so keep our own copy
+        window = np.array(audio_chunk, dtype=np.float32, copy=True)
+        future = asyncio.ensure_future(self.scheduler.submit(window, self.label, self.beam_size))
+        self._pending.append((future, position))
+        self._ready.set()
+        if len(self._pending) > self.max_pending:
+            # Do not run further ahead of the model than max_pending windows
+            await asyncio.wait({self._pending[0][0]})
+
+    async def get_transcripts(self):
+        while self._running or self._pending:
+            if self._pending:
+                future, position = self._pending.popleft()
+                try:
+                    segments = await future
+                except Exception:
+                    continue
+                text = " ".join(segment.text for segment in segments).strip()
+                if text:
+                    self.position = None if position is None else position + segments[0].start
+                    yield text
+            else:
+                self._ready.clear()
+                await self._ready.wait()
+
+    async def stop(self):
+        self._running = False
+        self._ready.set()
+
+    def cancel(self):
+        """Drop windows that are still waiting for the model"""
+        while self._pending:
+            self._pending.popleft()[0].cancel()
+
+def segments_to_words(segments, offset=0.0) -> List[Word]:
+    """Split segments into words, spreading each segment's time span by word length"""
+    words = []
+    for segment in segments:
+        tokens = segment.text.split()
+        total = sum(len(token) for token in tokens) or 1
+        start = segment.start
+        for token in tokens:
+            end = start + (segment.end - segment.start) * len(token) / total
+            words.append(Word(offset + start, offset + end, token))
+            start = end
+    return words
+
+def _same_word(a, b):
+    return a.text.lower().strip(".,!?;:\"'") == b.text.lower().strip(".,!?;:\"'")
+
+def drop_repeated_prefix(tail: List[Word], words: List[Word]) -> List[Word]:
+    """Drop the longest run at the start of `words` that repeats the end of `tail` (re-decoded overlap)"""
+    for n in range(min(len(tail), len(words)), 0, -1):
+        if all(_same_word(a, b) for a, b in zip(tail[-n:], words[:n])):
+            return words[n:]
+    return words
+
+class LocalAgreement:
+    """LocalAgreement-2 over consecutive hypotheses of the same audio.
+
+    A word is committed once two hypotheses in a row agree on it (longest
+    common prefix). Words that were committed earlier and show up again
+    because their audio was not trimmed yet are skipped by time and by
+    n-gram overlap with the committed tail.
+    """
+    __slots__ = ("committed_until", "_previous", "_committed_tail")
 
-class WhisperStreamStub:
     def __init__(self):
-        self._buffer = []
-        self._transcripts = []
+        self.committed_until = 0.0
+        self._previous: List[Word] = []
+        # Tail of the committed words, for de-duplicating re-decoded audio
+        self._committed_tail = deque(maxlen=5)
+
+    def _new_words(self, words):
+        words = [w for w in words if w.start > self.committed_until - 0.1]
+        return drop_repeated_prefix(list(self._committed_tail), words)
+
+    def insert(self, words: List[Word]) -> List[Word]:
+        """Add a hypothesis; returns the words committed by it"""
+        words = self._new_words(words)
+        n = 0
+        while n < len(words) and n < len(self._previous) and _same_word(words[n], self._previous[n]):
+            n += 1
+        self._previous = words[n:]
+        return self._commit(words[:n])
+
+    def pending(self) -> List[Word]:
+        return list(self._previous)
+
+    def flush(self) -> List[Word]:
+        """Commit whatever the last hypothesis said"""
+        words, self._previous = self._previous, []
+        return self._commit(words)
+
+    def commit_until(self, time) -> List[Word]:
+        """Force-commit pending words ending by `time`"""
+        n = 0
+        while n < len(self._previous) and self._previous[n].end <= time + 1e-6:
+            n += 1
+        words, self._previous = self._previous[:n], self._previous[n:]
+        return self._commit(words)
+
+    def _commit(self, words):
+        if words:
+            self.committed_until = words[-1].end
+            self._committed_tail.extend(words)
+        return words
+
+class StabilizedStream:
+    """Streaming transcription that re-decodes the uncommitted audio and commits only stable words.
+
+    Speech segments are appended to one audio buffer and the whole buffer
+    is decoded again after each of them. LocalAgreement decides which words
+    are final. The buffer is trimmed at the end of the last segment whose
+    words are all committed, so each decode covers a bounded amount of
+    audio, however long the speaker goes on. The unstable tail is reported
+    through on_partial, and the latency of every committed word (audio
+    arrival to commit) goes to the committed_word_latency metric.
+    """
+
+    def __init__(self, scheduler: InferenceScheduler, label=None, max_buffer_seconds=STABILIZE_MAX_BUFFER_SECONDS):
+        self.scheduler = scheduler
+        self.label = label
+        self.beam_size = None
+        self.max_buffer = int(max_buffer_seconds * SAMPLE_RATE)
+        self.agreement = LocalAgreement()
+        self.on_partial = None  # Callback(text) with the current unstable tail
+        self.position = None  # Stream position of the transcript yielded last (see WhisperStream)
+        # Uncommitted audio; _offset is the speech-timeline position of its first sample
+        self._audio = np.zeros(self.max_buffer * 2, dtype=np.float32)
+        self._length = 0
+        self._offset = 0.0
+        # (timeline end of a fed chunk, monotonic time it arrived, its stream end position or None)
+        self._arrivals = deque()
+        self._committed = deque()
+        self._ready = asyncio.Event()
         self._running = True
+        self._latency = metrics.committed_word_latency_seconds.labels(label or "")
 
-    async def feed(self, audio_chunk):
-        # Simulate processing
-        await asyncio.sleep(0.01)
-        # For stub, just append a dummy transcript for every chunk
-        self._transcripts.append("[transcript for chunk]")
+    def _append(self, chunk, position=None):
+        if self._length + len(chunk) > len(self._audio):
+            grown = np.zeros(self._length + len(chunk), dtype=np.float32)
+            grown[:self._length] = self._audio[:self._length]
+            self._audio = grown
+        self._audio[self._length:self._length + len(chunk)] = chunk
+        self._length += len(chunk)
+        stream_end = None if position is None else position + len(chunk) / SAMPLE_RATE
+        self._arrivals.append((self._offset + self._length / SAMPLE_RATE, time.monotonic(), stream_end))
+
+    def _trim(self, until):
+        """Drop buffered audio before timeline position `until`"""
+        n = min(max(int(round((until - self._offset) * SAMPLE_RATE)), 0), self._length)
+        if not n:
+            return
+        self._audio[:self._length - n] = self._audio[n:self._length]
+        self._length -= n
+        self._offset += n / SAMPLE_RATE
+        while self._arrivals and self._arrivals[0][0] <= self._offset:
+            self._arrivals.popleft()
+
+    def _emit(self, words):
+        if not words:
+            return
+        now = time.monotonic()
+        for word in words:
+            arrived = next((fed_at for end, fed_at, _ in self._arrivals if end >= word.end - 1e-6), now)
+            self._latency.observe(now - arrived)
+        # Map the first word from the speech timeline back to the stream through the chunk it was heard in
+        start = words[0].start
+        position = next((stream_end - (end - start) for end, _, stream_end in self._arrivals
+                         if end > start and stream_end is not None), None)
+        self._committed.append((" ".join(word.text for word in words), position))
+        self._ready.set()
+
+    async def feed(self, audio_chunk, position=None):
+        self._append(np.asarray(audio_chunk, dtype=np.float32), position)
+        segments = await self.scheduler.submit(self._audio[:self._length].copy(), self.label, self.beam_size)
+        self._emit(self.agreement.insert(segments_to_words(segments, self._offset)))
+        ends = [self._offset + segment.end for segment in segments]
+        if self._length > self.max_buffer:
+            # The speaker never paused long enough for agreement: commit all but the last segment
+            cut = ends[-2] if len(ends) > 1 else self._offset + self._length / SAMPLE_RATE
+            self._emit(self.agreement.commit_until(cut))
+            self._trim(cut)
+        else:
+            # Cut at a segment boundary so the model never sees half a committed sentence
+            done = [end for end in ends if end <= self.agreement.committed_until + 1e-6]
+            if done:
+                self._trim(done[-1])
+        if self.on_partial:
+            pending = " ".join(word.text for word in self.agreement.pending())
+            if pending:
+                await self.on_partial(pending)
+
+    async def flush(self):
+        """The speaker paused: commit the pending words and start a fresh buffer"""
+        self._emit(self.agreement.flush())
+        self._trim(self._offset + self._length / SAMPLE_RATE)
 
     async def get_transcripts(self):
-        # Simulate streaming transcripts
-        while self._running or self._transcripts:
-            if self._transcripts:
-                yield self._transcripts.pop(0)
+        while self._running or self._committed:
+            if self._committed:
+                text, self.position = self._committed.popleft()
+                yield text
             else:
-                await asyncio.sleep(0.05)
+                self._ready.clear()
+                await self._ready.wait()
 
     async def stop(self):
+        await self.flush()
         self._running = False
+        self._ready.set()
+
+    def cancel(self):
+        self.agreement = LocalAgreement()
+        self._length = 0
 
 class WhisperTranscriber:
-    def __init__(self):
-        pass
+    def __init__(self, scheduler: Optional[InferenceScheduler] = None):
+        self.scheduler = scheduler
+
+    async def _get_scheduler(self):
+        return self.scheduler or await load_scheduler()
 
     async def transcribe(self, audio_chunk):
-        # Placeholder: implement whisper_streaming transcription
-        await asyncio.sleep(0)  # Simulate async
-        return None
+        segments = await (await self._get_scheduler()).submit(audio_chunk)
+        return " ".join(segment.text for segment in segments).strip() or None
 
-    async def start_streaming(self):
+    async def start_streaming(self, label=None, stabilize=WHISPER_STABILIZE):
         # Async context manager for streaming
+        scheduler = await self._get_scheduler()
         class _StreamContext:
             async def __aenter__(self_):
-                self_._stream = WhisperStreamStub()
+                if stabilize:
+                    self_._stream = StabilizedStream(scheduler, label=label)
+                else:
+                    self_._stream = WhisperStream(scheduler, label=label)
                 return self_._stream
             async def __aexit__(self_, exc_type, exc, tb):
+                if exc_type is not None:
+                    self_._stream.cancel()
                 await self_._stream.stop()
-        return _StreamContext() 
\ No newline at end of file
+        return _StreamContext()
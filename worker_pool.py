@@ -0,0 +1,200 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import List
+import numpy as np
+from whisper_transcriber import SAMPLE_RATE, WhisperBackend, create_backend
+
+# Run the model in this many worker processes; 0 keeps inference in threads of the bot process
+INFERENCE_PROCESSES = int(os.getenv("INFERENCE_PROCESSES", "0"))
+# Longest window a worker accepts; Whisper never looks past 30 s anyway
+WORKER_MAX_WINDOW_SECONDS = 30
+# A batch taking longer than this is treated as a hung worker
+WORKER_TIMEOUT = float(os.getenv("INFERENCE_WORKER_TIMEOUT", "120"))
+
+class WorkerCrashed(RuntimeError):
+    """The worker process died or stopped answering; it is restarted"""
+
+def _worker_main(conn, shm_name, backend_factory, backend_name):
+    """Worker process: load the model, then transcribe batches described by (offset, length) pairs"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slab = np.ndarray((shm.size // 4,), dtype=np.float32, buffer=shm.buf)
+    try:
+        backend = backend_factory() if backend_factory is not None else create_backend(backend_name)
+        conn.send(("ready", None))
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+            spans, beam_size = request
+            # Views into shared memory; the parent does not touch the slab until we reply
+            windows = [slab[offset:offset + length] for offset, length in spans]
+            try:
+                if beam_size is None:
+                    conn.send(("ok", backend.transcribe_batch(windows)))
+                else:
+                    conn.send(("ok", backend.transcribe_batch(windows, beam_size=beam_size)))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+            del windows
+    finally:
+        del slab
+        shm.close()
+
+class _Worker:
+    """One worker process plus the shared-memory slab its input windows are written to"""
+
+    def __init__(self, index, slab_samples, backend_factory, backend_name):
+        self.index = index
+        self.backend_factory = backend_factory
+        self.backend_name = backend_name
+        self.shm = shared_memory.SharedMemory(create=True, size=slab_samples * 4)
+        self.slab = np.ndarray((slab_samples,), dtype=np.float32, buffer=self.shm.buf)
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self.failures = 0
+        # Loading the model may take long (downloads); the hang timeout starts once it is ready
+        self.ready = False
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.shm.name, self.backend_factory, self.backend_name),
+            name=f"whisper-worker-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.ready = False
+
+    def stop(self, timeout=5.0):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+
+    def restart(self):
+        self.stop(timeout=0)
+        self.restarts += 1
+        self.failures += 1
+        # Back off when the worker keeps crashing, e.g. because the model cannot load
+        delay = min(2 ** (self.failures - 1) - 1, 30)
+        print(f"Restarting Whisper worker {self.index} in {delay}s (restart #{self.restarts})")
+        time.sleep(delay)
+        self.start()
+
+    def transcribe(self, windows, beam_size=None, timeout=WORKER_TIMEOUT):
+        spans = []
+        offset = 0
+        for window in windows:
+            if offset + len(window) > len(self.slab):
+                raise ValueError(f"Batch of {len(windows)} windows does not fit the worker slab")
+            self.slab[offset:offset + len(window)] = window
+            spans.append((offset, len(window)))
+            offset += len(window)
+        # Only (offset, length) pairs go through the pipe; the audio is already in shared memory
+        try:
+            self.conn.send((spans, beam_size))
+        except OSError as e:
+            raise WorkerCrashed(f"Whisper worker {self.index} is gone: {e}")
+        deadline = time.monotonic() + timeout
+        while True:
+            if not self.conn.poll(0.5):
+                if not self.process.is_alive():
+                    raise WorkerCrashed(f"Whisper worker {self.index} exited with code {self.process.exitcode}")
+                if self.ready and time.monotonic() > deadline:
+                    raise WorkerCrashed(f"Whisper worker {self.index} did not answer within {timeout:.0f}s")
+                continue
+            try:
+                status, result = self.conn.recv()
+            except (EOFError, OSError):
+                raise WorkerCrashed(f"Whisper worker {self.index} closed its pipe")
+            if status == "ready":
+                self.ready = True
+                deadline = time.monotonic() + timeout
+                continue
+            if status != "ok":
+                raise RuntimeError(f"Whisper worker {self.index} failed: {result}")
+            self.failures = 0
+            return result
+
+class ProcessPoolBackend(WhisperBackend):
+    """Runs another backend in worker processes so decoding never competes with the gateway for the GIL.
+
+    Each worker owns a shared-memory slab holding max_batch windows.
+    Audio is copied into it directly and only offsets and the resulting
+    segments are pickled. A worker that crashes or hangs is replaced and
+    its batch fails; later batches are not affected.
+
+    backend_factory must be picklable (a module-level class or function);
+    by default the worker builds the backend named by WHISPER_BACKEND.
+    """
+
+    def __init__(self, processes=INFERENCE_PROCESSES, max_batch=None, backend_factory=None, backend_name=None):
+        from whisper_transcriber import INFERENCE_MAX_BATCH, WHISPER_BACKEND
+        max_batch = max_batch or INFERENCE_MAX_BATCH
+        slab_samples = max_batch * WORKER_MAX_WINDOW_SECONDS * SAMPLE_RATE
+        self._workers: List[_Worker] = [
+            _Worker(i, slab_samples, backend_factory, backend_name or WHISPER_BACKEND)
+            for i in range(max(processes, 1))
+        ]
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        for worker in self._workers:
+            worker.start()
+            self._idle.put(worker)
+
+    @property
+    def processes(self):
+        return len(self._workers)
+
+    def transcribe_batch(self, windows, beam_size=None):
+        worker = self._idle.get()
+        try:
+            if not worker.process.is_alive():
+                # Died while idle: replace it before handing it a batch
+                worker.restart()
+            return worker.transcribe(windows, beam_size)
+        except WorkerCrashed:
+            with self._lock:
+                if not self._closed:
+                    worker.restart()
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def stats(self):
+        return {
+            "processes": len(self._workers),
+            "alive": sum(1 for w in self._workers if w.process is not None and w.process.is_alive()),
+            "restarts": sum(w.restarts for w in self._workers),
+        }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        for worker in self._workers:
+            worker.stop()
+            # The slab view must go before the mapping can be closed
+            worker.slab = None
+            worker.shm.close()
+            worker.shm.unlink()